@@ -11,15 +11,21 @@ from .sublack import (
     SETTINGS_FILE_NAME,
     get_settings,
     cache_path,
-    clear_cache,
     Path,
     BlackFileCommand,
     BlackDiffCommand,
+    BlackApplyCommand,
+    BlackFormatSelectionCommand,
     BlackToggleBlackOnSaveCommand,
     BlackEventListener,
+    BlackOnSaveListener,
     BlackdStartCommand,
     BlackdStopCommand,
     BlackFormatAllCommand,
+    BlackFormatChangedCommand,
+    BlackFormatAllCancelCommand,
+    BlackWorker,
+    IndexWorker,
 )  # flake8: noqa
 
 LOG = logging.getLogger(PACKAGE_NAME)
@@ -58,9 +64,6 @@ def plugin_loaded():
     if not cp.exists():
         cp.mkdir()
 
-    # clear cache
-    clear_cache()
-
     # # check blackd autostart
     if config["black_blackd_autostart"]:
         sublime.set_timeout_async(lambda: current_view.run_command("blackd_start"), 0)
@@ -69,3 +72,8 @@ def plugin_loaded():
     sublime.load_settings(SETTINGS_FILE_NAME).add_on_change(
         "black_log", lambda: Path(__file__).touch()
     )
+
+
+def plugin_unloaded():
+    BlackWorker.stop_all()
+    IndexWorker.stop_all()
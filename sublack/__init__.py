@@ -10,19 +10,27 @@ from .utils import (
     kill_with_pid,
     Path,
 )
-from .server import BlackdServer
-from .blacker import Blackd, Black
+from .server import BlackdServer, BlackWorker, IndexWorker
+from .blacker import Blackd, Black, FormatJob
 from .commands import (
     is_python,
     BlackFileCommand,
     BlackDiffCommand,
+    BlackApplyCommand,
+    BlackFormatSelectionCommand,
     BlackToggleBlackOnSaveCommand,
     BlackEventListener,
+    BlackOnSaveListener,
     BlackdStartCommand,
     BlackdStopCommand,
     BlackFormatAllCommand,
+    BlackFormatChangedCommand,
+    BlackFormatAllCancelCommand,
 )
 from .checker import Checker
+from .cache import FormatCache
+from .formatall import FormatAll, GitFormatAll
+from .matcher import FileMatcher
 
 
 __all__ = [
@@ -37,15 +45,27 @@ __all__ = [
     "kill_with_pid",
     "check_blackd_on_http",
     "BlackdServer",
+    "BlackWorker",
+    "IndexWorker",
     "Black",
     "Blackd",
+    "FormatJob",
     "is_python",
     "BlackFileCommand",
     "BlackDiffCommand",
+    "BlackApplyCommand",
+    "BlackFormatSelectionCommand",
     "BlackToggleBlackOnSaveCommand",
     "BlackEventListener",
+    "BlackOnSaveListener",
     "BlackdStartCommand",
     "BlackdStopCommand",
     "BlackFormatAllCommand",
+    "BlackFormatChangedCommand",
+    "BlackFormatAllCancelCommand",
     "Checker",
+    "FormatCache",
+    "FormatAll",
+    "GitFormatAll",
+    "FileMatcher",
 ]
@@ -5,6 +5,8 @@ Sublime Text 3 Plugin to invoke Black on a Python file.
 import os.path
 import os
 import subprocess
+import threading
+import tokenize
 
 import sublime
 
@@ -18,35 +20,158 @@ from .consts import (
     STATUS_KEY,
     PACKAGE_NAME,
     REFORMATTED_MESSAGE,
+    REFORMATTED_MESSAGE_CACHE,
+    FORMATTING_MESSAGE,
+    FORMAT_FAILED_MESSAGE,
+    NOTHING_TO_FORMAT_MESSAGE,
 )
 from .utils import (
     get_settings,
     get_encoding_from_file,
     cache_path,
     find_root_file,
+    find_pyproject,
+    read_pyproject_toml,
     use_pre_commit,
+    read_pre_commit_config,
     Path,
     get_env,
+    get_black_version,
+    parse_black_version,
+    import_black,
+)
+from .cache import FormatCache, digest
+from .server import BlackWorker, BlackWorkerError
+from .worker import format_with_black, UnsupportedOption
+
+from .precommit import resolve as resolve_pre_commit
+from .folding import unfold_changed, refold_changed
+from .diffing import LineDiff, ViewState, apply_diff
+from .ranges import (
+    top_level_blocks,
+    blocks_for_lines,
+    line_ranges_args,
+    without_line_ranges,
+    supports_line_ranges,
+    splice,
 )
-
-from .folding import get_folded_lines, get_ast_index, refold_all
 
 
 LOG = logging.getLogger(PACKAGE_NAME)
 
 
+def get_command_line(config, variables, filename=None, extra=[]):
+    """black command line for sublack options. filename is the formatted file,
+    if any."""
+    # prepare popen arguments
+    cmd = config["black_command"]
+    if not cmd:
+        # always show error in popup
+        msg = "Black command not configured. Problem with settings ?"
+        sublime.error_message(msg)
+        raise Exception(msg)
+
+    cmd = os.path.expanduser(cmd)
+
+    cmd = sublime.expand_variables(cmd, variables)
+
+    # set  black in input/ouput mode with -
+    cmd = [cmd, "-"]
+
+    # extra args
+    if extra:
+        cmd.extend(extra)
+
+    # add black specific config to cmmandline
+
+    # Line length option
+    if config.get("black_line_length"):
+        cmd.extend(["-l", str(config["black_line_length"])])
+
+    # fast
+    if config.get("black_fast", None):
+        cmd.append("--fast")
+
+    # black_skip_string_normalization
+    if config.get("black_skip_string_normalization"):
+        cmd.append("--skip-string-normalization")
+
+    # handle pyi
+    if filename and filename.endswith(".pyi"):
+        cmd.append("--pyi")
+
+    # black_py36
+    if config.get("black_py36"):
+        cmd.append("--py36")
+
+    # black target-vversion
+    if config.get("black_target_version"):
+        versions = []
+        for v in config["black_target_version"]:
+            cmd.extend(["--target-version", v])
+
+    LOG.debug("command line: %s", cmd)
+    return cmd
+
+
 class Blackd:
     """warpper between black command line and blackd."""
 
-    def __init__(self, cmd, content, encoding, config):
+    # keep-alive sessions per url and request headers per options, for the
+    # life of the plugin_host
+    sessions = {}
+    templates = {}
 
-        self.headers = self.format_headers(cmd)
+    def __init__(self, cmd, content, encoding, config, on_unreachable=None):
+        """on_unreachable(message) is called if blackd isn't running,
+        show_unreachable by default"""
+        self.headers = self.get_headers(cmd, encoding)
         self.content = content
         self.encoding = encoding
         self.config = config
+        self.on_unreachable = on_unreachable or self.show_unreachable
+        self.url = "http://{}:{}/".format(
+            config["black_blackd_host"], config["black_blackd_port"]
+        )
 
-    def format_headers(self, cmd):
+    @classmethod
+    def get_headers(cls, cmd, encoding):
+        key = (tuple(cmd), encoding)
+        if key not in cls.templates:
+            headers = cls.format_headers(cmd)
+            headers["Content-Type"] = "application/octet-stream; charset=" + encoding
+            cls.templates[key] = headers
+        return cls.templates[key]
+
+    @classmethod
+    def get_session(cls, url):
+        if url not in cls.sessions:
+            LOG.debug("new blackd session for %s", url)
+            cls.sessions[url] = requests.Session()
+        return cls.sessions[url]
+
+    @classmethod
+    def close_session(cls, url):
+        session = cls.sessions.pop(url, None)
+        if session:
+            session.close()
+
+    def post(self):
+        """post to blackd, reconnecting once if the kept alive connection was
+        dropped"""
+        try:
+            return self.get_session(self.url).post(
+                self.url, data=self.content, headers=self.headers
+            )
+        except requests.ConnectionError:
+            LOG.debug("blackd connection lost, reconnecting")
+            self.close_session(self.url)
+            return self.get_session(self.url).post(
+                self.url, data=self.content, headers=self.headers
+            )
 
+    @staticmethod
+    def format_headers(cmd):
         """Get command line args and turn it to properly formatted headers"""
         headers = {}
 
@@ -75,6 +200,10 @@ class Blackd:
         LOG.debug("headers : %s", headers)
         return headers
 
+    @staticmethod
+    def show_unreachable(msg):
+        sublime.message_dialog(msg + ", you can start it with blackd_start command")
+
     def process_response(self, response):
         """Format to the Popen format.
 
@@ -98,26 +227,15 @@ class Blackd:
         return response
 
     def __call__(self):
-
-        self.headers.update(
-            {"Content-Type": "application/octet-stream; charset=" + self.encoding}
-        )
-        url = (
-            "http://"
-            + self.config["black_blackd_host"]
-            + ":"
-            + self.config["black_blackd_port"]
-            + "/"
-        )
         try:
-            response = requests.post(url, data=self.content, headers=self.headers)
+            response = self.post()
         except requests.ConnectionError as err:
 
             msg = "blackd not running on port {}".format(
                 self.config["black_blackd_port"]
             )
             response = self.process_errros(msg)
-            sublime.message_dialog(msg + ", you can start it with blackd_start command")
+            self.on_unreachable(msg)
         except Exception as err:
             response = self.process_errros(str(err))
             LOG.error("Request to  Blackd failed")
@@ -125,17 +243,72 @@ class Blackd:
         return self.process_response(response)
 
 
+def run_formatter(
+    cmd,
+    content,
+    encoding,
+    config,
+    pyproject,
+    run_black,
+    on_blackd_unreachable=None,
+    worker=None,
+):
+    """Format content with the transport chosen by sublack options: black's
+    api in process, blackd or the black worker. run_black(cmd, content) runs
+    black's command line, used by default or as fallback.
+
+    Shared by Black and format all. pyproject: [tool.black] table. worker:
+    BlackWorker used instead of the one shared for cmd.
+    Returns the Popen format: returncode(int), out(byte), err(byte)"""
+    if config["black_mode"] == "inprocess":
+        # black is only used if it's the same version as black_command
+        black = import_black(config["black_sys_path"])
+        version = parse_black_version(get_black_version(cmd[0])[1])
+        if black and black.__version__ == version:
+            LOG.debug("using black in process")
+            try:
+                return format_with_black(black, cmd[1:], content, pyproject)
+            except UnsupportedOption as err:
+                LOG.debug("%s, falling back to black command", err)
+        else:
+            LOG.warning(
+                "black %s not importable or not the same version as %s, "
+                "falling back to black command",
+                getattr(black, "__version__", ""),
+                cmd[0],
+            )
+    elif config["black_use_blackd"]:
+        LOG.debug("using blackd")
+        return Blackd(cmd, content, encoding, config, on_blackd_unreachable)()
+    elif config["black_use_worker"]:
+        LOG.debug("using black worker")
+        try:
+            worker = worker or BlackWorker.get(cmd[0], config)
+            return worker(cmd[1:], content, pyproject)
+        except BlackWorkerError as err:
+            LOG.error("%s, falling back to black command", err)
+
+    LOG.debug("using black")
+    return run_black(cmd, content)
+
+
 class Black:
     """
     This class wraps Back invocation
     """
 
+    # text of each view after its last format, by view id
+    formatted_texts = {}
+
     def __init__(self, view):
         self.view = view
         self.config = get_settings(view)
         self.all = sublime.Region(0, self.view.size())
         self.variables = view.window().extract_variables()
-        self.formatted_cache = cache_path() / "formatted"
+        self.formatted_cache = FormatCache.open(cache_path() / "formatted")
+        self.viewport = None  # viewport position after the last format
+        # [tool.black] table, read by black itself besides its command line
+        self.pyproject = read_pyproject_toml(find_pyproject(view))
 
         LOG.debug("config: %s", self.config)
         if self.config["black_use_precommit"]:
@@ -145,57 +318,20 @@ class Black:
         else:
             self.pre_commit_config = False
 
-    def get_command_line(self, edit, extra=[]):
-        # prepare popen arguments
-        cmd = self.config["black_command"]
-        if not cmd:
-            # always show error in popup
-            msg = "Black command not configured. Problem with settings ?"
-            sublime.error_message(msg)
-            raise Exception(msg)
-
-        cmd = os.path.expanduser(cmd)
-
-        cmd = sublime.expand_variables(cmd, self.variables)
-
-        # set  black in input/ouput mode with -
-        cmd = [cmd, "-"]
-
-        # extra args
-        if extra:
-            cmd.extend(extra)
-
-        # add black specific config to cmmandline
-
-        # Line length option
-        if self.config.get("black_line_length"):
-            cmd.extend(["-l", str(self.config["black_line_length"])])
-
-        # fast
-        if self.config.get("black_fast", None):
-            cmd.append("--fast")
-
-        # black_skip_string_normalization
-        if self.config.get("black_skip_string_normalization"):
-            cmd.append("--skip-string-normalization")
-
-        # handle pyi
-        filename = self.view.file_name()
-        if filename and filename.endswith(".pyi"):
-            cmd.append("--pyi")
-
-        # black_py36
-        if self.config.get("black_py36"):
-            cmd.append("--py36")
-
-        # black target-vversion
-        if self.config.get("black_target_version"):
-            versions = []
-            for v in self.config["black_target_version"]:
-                cmd.extend(["--target-version", v])
+        # black of the pre-commit hook, run without pre-commit if installed
+        self.pre_commit_black = None
+        if self.pre_commit_config:
+            self.pre_commit_black = resolve_pre_commit(
+                read_pre_commit_config(self.pre_commit_config)
+            )
+            LOG.debug("pre-commit black: %s", self.pre_commit_black)
 
-        LOG.debug("command line: %s", cmd)
-        return cmd
+    def get_command_line(self, edit, extra=[]):
+        if self.pre_commit_black:
+            return self.pre_commit_black.get_command_line(self.view.file_name(), extra)
+        return get_command_line(
+            self.config, self.variables, self.view.file_name(), extra
+        )
 
     def windows_popen_prepare(self):
         # win32: hide console window
@@ -225,7 +361,8 @@ class Black:
         LOG.debug("encoding: %s", encoding)
         return content, encoding
 
-    def run_black(self, cmd, env, cwd, content):
+    def run_black(self, cmd, env, cwd, content, job=None):
+        """job: FormatJob, running process is attached to it to be cancelable"""
         try:
             p = subprocess.Popen(
                 cmd,
@@ -236,6 +373,8 @@ class Black:
                 stderr=subprocess.PIPE,
                 startupinfo=self.windows_popen_prepare(),
             )
+            if job:
+                job.attach(p)
             out, err = p.communicate(input=content)
 
         except UnboundLocalError as err:  # unboud pour p si popen echoue
@@ -278,31 +417,22 @@ class Black:
 
         return folders[0]
 
+    def cache_key(self, content, cmd):
+        return digest(content, cmd, get_black_version(cmd[0]), self.pyproject)
+
     def is_cached(self, content, cmd):
-        h_content = hash(content)
-        cache = self.formatted_cache.open().read().splitlines()
-        for line in cache:
-            content_f, cmd_f = line.split("|||")
-            if int(content_f) == h_content:
-                if cmd_f == str(cmd):
-                    return True
-        return False
-
-    def add_to_cache(self, content, cmd):
-        if self.is_cached(content, cmd):
-            return
-        with self.formatted_cache.open("r+") as cache:
-            old = cache.read().splitlines()
-            if len(old) > 250:
-                old.pop()
+        return self.cache_key(content, cmd) in self.formatted_cache
 
-            cache.seek(0)
-            new = [str(hash(content)) + "|||" + str(cmd)]
-            LOG.debug("write to cache %s", str(new))
+    def get_cached(self, content, cmd):
+        """Return formatted content from cache or None if not cached"""
+        out = self.formatted_cache.lookup(self.cache_key(content, cmd))
+        if out is FormatCache.MISSING:
+            return None
+        return content if out is None else out
 
-            new_file = "\n".join((new + old))
-            cache.write(new_file)
-            return True
+    def add_to_cache(self, content, cmd, out=None):
+        """Cache out as black's output for content. out is None if unchanged."""
+        return self.formatted_cache.add(self.cache_key(content, cmd), out)
 
     def finalize(self, edit, extra, returncode, out, err, content, cmd, encoding):
         error_message = err.decode(encoding).replace("\r\n", "\n").replace("\r", "\n")
@@ -317,6 +447,7 @@ class Black:
         elif "unchanged" in error_message:
             self.view.set_status(STATUS_KEY, ALREADY_FORMATTED_MESSAGE)
             self.add_to_cache(content, cmd)
+            self.formatted_texts[self.view.id()] = content.decode(encoding)
 
         # diff mode
         elif "--diff" in extra:
@@ -324,25 +455,24 @@ class Black:
 
         # standard mode
         else:
-            # setup folding
-            old_sel = self.view.sel()[0]
-            folded_lines = get_folded_lines(self.view)
-
-            # result of formatting
-            new_content = out.decode(encoding)
-            self.view.replace(edit, self.all, new_content)
-
-            # reapply folding
-            old = get_ast_index(self.view, content, encoding)
-            new = get_ast_index(self.view, out, encoding)
-            if old and new:
-                refold_all(old, new, self.view, folded_lines)
-            self.view.sel().clear()
-            self.view.sel().add(old_sel)
+            # result of formatting, only changed lines are replaced
+            diff = LineDiff(content.decode(encoding), out.decode(encoding))
+            state = ViewState(self.view)
+            folded = unfold_changed(self.view, diff)
+            apply_diff(self.view, edit, diff)
+
+            # reapply folding, then selections and viewport
+            refold_changed(self.view, diff, folded, content, out, encoding)
+            state.restore(diff)
+            self.viewport = state.viewport
 
             # status and caching
             self.view.set_status(STATUS_KEY, REFORMATTED_MESSAGE)
-            sublime.set_timeout_async(lambda: self.add_to_cache(new_content, cmd))
+            self.add_to_cache(content, cmd, out)
+            if "--line-ranges" not in cmd:
+                # other lines of out may still need formatting
+                self.add_to_cache(out, cmd)
+            self.formatted_texts[self.view.id()] = out.decode(encoding)
 
     def format_via_precommit(self, edit, content, cwd, env):
         cmd = ["pre-commit", "run", "black", "--files"]
@@ -368,7 +498,7 @@ class Black:
                 stderr=subprocess.STDOUT,
                 stdout=subprocess.PIPE,
             )
-            print(a.stdout.read())
+            LOG.debug("pre-commit: %s", a.stdout.read().decode(errors="replace"))
         except subprocess.CalledProcessError as err:
             LOG.error(err)
             return err
@@ -379,37 +509,284 @@ class Black:
         self.view.replace(edit, self.all, tmp.read_text())
         sublime.set_timeout_async(lambda: tmp.unlink())
 
-    def __call__(self, edit, extra=[]):
+    def modified_lines(self):
+        """Lines modified since the last format, None if unknown"""
+        old = self.formatted_texts.get(self.view.id())
+        if old is None:
+            return None
+        return LineDiff(old, self.view.substr(self.all)).changed_lines()
+
+    def get_blocks(self, content, encoding, lines):
+        """Top level blocks containing lines, None to format the whole file"""
+        if lines is None:
+            return None
+        try:
+            blocks = top_level_blocks(content.decode(encoding))
+        except (tokenize.TokenError, SyntaxError) as err:
+            LOG.debug("can't find blocks (%s), formatting whole file", err)
+            return None
+        return blocks_for_lines(blocks, lines)
+
+    def prepare(self, extra=[], lines=None):
+        """Snapshot of the view needed to format it. Must run on UI thread.
 
-        # get command_line  + args
+        lines: only format top level statements containing these lines"""
         content, encoding = self.get_content()
         cwd = self.get_good_working_dir()
         LOG.debug("working dir: %s", cwd)
-        env = get_env()
+        cmd = self.get_command_line(None, extra)
+        blocks = self.get_blocks(content, encoding, lines)
+        if blocks:
+            cmd.extend(line_ranges_args(blocks))
+        return FormatJob(
+            self.view, content, encoding, cmd, cwd, get_env(), extra, blocks
+        )
 
-        if self.pre_commit_config:
-            LOG.debug("Using pre-commit with %s", self.pre_commit_config)
-            self.format_via_precommit(edit, content.decode(encoding), cwd, env)
+    def use_line_ranges(self, cmd):
+        """black used for cmd can format line ranges itself"""
+        if self.config["black_use_blackd"] and self.config["black_mode"] != "inprocess":
+            return False
+        return supports_line_ranges(get_black_version(cmd[0])[1])
+
+    def format_blocks(self, job):
+        """Format each block alone then splice them back in content"""
+        text = job.content.decode(job.encoding)
+        lines = text.splitlines(True)
+        cmd = without_line_ranges(job.cmd)
+        formatted = []
+        for first, last in job.blocks:
+            # blocks have no coding cookie: black reads them as utf-8
+            block = "".join(lines[first : last + 1]).encode("utf-8")
+            returncode, out, err = self.format(job.derive(block, "utf-8", cmd))
+            if returncode != 0:
+                return returncode, out, err
+            formatted.append(out.decode("utf-8"))
+
+        new = splice(text, job.blocks, formatted)
+        if new == text:
+            return 0, job.content, b"1 file left unchanged"
+        return 0, new.encode(job.encoding), b"1 file reformatted"
+
+    def format(self, job):
+        """Run black or blackd on job's content, use the cache if possible.
+
+        Doesn't touch the view, so it can run in background.
+        Returns the Popen format: returncode(int), out(byte), err(byte)"""
+        content, cmd, cwd, env, extra = (
+            job.content,
+            job.cmd,
+            job.cwd,
+            job.env,
+            job.extra,
+        )
+
+        # check the cache, keyed by black's command and version: pre-commit's
+        # black has its own entries
+        cached = self.get_cached(content, cmd)
+        if cached == content:
+            job.cached = True
+            return 0, cached, b"1 file left unchanged"
+        elif cached is not None and "--diff" not in extra:
+            LOG.debug("using cached output")
+            job.cached = True
+            return 0, cached, b"1 file reformatted"
+
+        # range formatting
+        if job.blocks is not None:
+            if (
+                not job.blocks
+                or self.get_cached(content, without_line_ranges(cmd)) == content
+            ):
+                return 0, content, b"1 file left unchanged"
+            if not self.use_line_ranges(cmd):
+                LOG.debug("black can't format line ranges, splicing blocks")
+                return self.format_blocks(job)
+
+        # call black or balckd
+
+        # pre-commit's black may not be blackd's, the worker's or sublime's one
+        if "--diff" in extra or self.pre_commit_black:  # no diff with servers
+            LOG.debug("using black")
+            return self.run_black(cmd, env, cwd, content, job=job)
+        return run_formatter(
+            cmd,
+            content,
+            job.encoding,
+            self.config,
+            self.pyproject,
+            lambda cmd, content: self.run_black(cmd, env, cwd, content, job=job),
+        )
+
+    def apply(self, edit, job):
+        """format/diff in editor"""
+        returncode, out, err = job.result
+        if job.blocks == []:
+            self.view.set_status(STATUS_KEY, NOTHING_TO_FORMAT_MESSAGE)
             return
-        else:
-            cmd = self.get_command_line(edit, extra)
+        self.finalize(
+            edit, job.extra, returncode, out, err, job.content, job.cmd, job.encoding
+        )
+        if job.cached:
+            self.view.set_status(
+                STATUS_KEY,
+                ALREADY_FORMATTED_MESSAGE_CACHE
+                if out == job.content
+                else REFORMATTED_MESSAGE_CACHE,
+            )
 
-        # check the cache
-        # cache may not be used with pre-commit
-        if self.is_cached(content, cmd):
-            self.view.set_status(STATUS_KEY, ALREADY_FORMATTED_MESSAGE_CACHE)
+    def format_async(self, extra=[], lines=None):
+        """Format in background, then apply the result with the black_apply
+        command if the view didn't change meanwhile."""
+        if self.pre_commit_config and not self.pre_commit_black:
+            LOG.debug("pre-commit can't run asynchronously")
+            self.view.run_command("black_file", {"sync": True})
             return
 
-        # call black or balckd
+        self.view.set_status(STATUS_KEY, FORMATTING_MESSAGE)
+        scheduler.submit(self, self.prepare(extra, lines))
+
+    def __call__(self, edit, extra=[], lines=None):
+
+        if self.pre_commit_config and not self.pre_commit_black:
+            content, encoding = self.get_content()
+            cwd = self.get_good_working_dir()
+            LOG.debug("Using pre-commit with %s", self.pre_commit_config)
+            self.format_via_precommit(edit, content.decode(encoding), cwd, get_env())
+            return
 
-        if (
-            self.config["black_use_blackd"] and "--diff" not in extra
-        ):  # no diff with server
-            LOG.debug("using blackd")
-            returncode, out, err = Blackd(cmd, content, encoding, self.config)()
+        # a background format would be discarded anyway
+        scheduler.cancel(self.view.id())
+
+        job = self.prepare(extra, lines)
+        job.result = self.format(job)
+        self.apply(edit, job)
+
+
+class FormatJob:
+    """Snapshot of a view to be formatted, and its result"""
+
+    # finished jobs waiting to be applied, by view id
+    done = {}
+
+    def __init__(self, view, content, encoding, cmd, cwd, env, extra, blocks=None):
+        self.view = view
+        self.change_count = view.change_count()
+        self.content = content
+        self.encoding = encoding
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.extra = extra
+        self.cached = False
+        self.result = None
+        self.cancelled = False
+        self.proc = None
+        self.blocks = blocks  # None: whole content
+        self.parent = None
+
+    def derive(self, content, encoding, cmd):
+        """Job formatting a part of this one"""
+        job = FormatJob(
+            self.view, content, encoding, cmd, self.cwd, self.env, self.extra
+        )
+        job.change_count = self.change_count
+        job.parent = self
+        return job
+
+    def same_as(self, other):
+        """other would give the same result"""
+        return (
+            self.change_count == other.change_count
+            and self.content == other.content
+            and self.cmd == other.cmd
+        )
+
+    def attach(self, proc):
+        if self.parent:
+            self.parent.attach(proc)
+            return
+        self.proc = proc
+        if self.cancelled:
+            self.cancel()
+
+    def cancel(self):
+        """Kill black's process if any. blackd/worker results are abandoned"""
+        self.cancelled = True
+        if self.proc and self.proc.poll() is None:
+            LOG.debug("killing superseded black process %s", self.proc.pid)
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+
+
+class FormatScheduler:
+    """Latest wins background formatting.
+
+    Only one job runs per view. A new request replaces the queued one and
+    cancels the running one, so black never runs for content which would
+    be thrown away."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}  # view id: (black, job)
+        self.queued = {}  # view id: (black, job)
+
+    def submit(self, black, job):
+        view_id = job.view.id()
+        with self.lock:
+            if view_id in self.running:
+                current = self.running[view_id][1]
+                if current.same_as(job) and not current.cancelled:
+                    LOG.debug("same format already running for view %s", view_id)
+                    self.queued.pop(view_id, None)
+                    return
+                current.cancel()
+                self.queued[view_id] = (black, job)
+                return
+            self.running[view_id] = (black, job)
+        sublime.set_timeout_async(lambda: self.run(black, job))
+
+    def cancel(self, view_id):
+        with self.lock:
+            self.queued.pop(view_id, None)
+            if view_id in self.running:
+                self.running[view_id][1].cancel()
+
+    def run(self, black, job):
+        view_id = job.view.id()
+        error = None
+        following = None
+        try:
+            if not job.cancelled:
+                job.result = black.format(job)
+        except Exception as err:
+            # black missing, worker or cache failure...
+            LOG.error("format of view %s failed: %s", view_id, err)
+            error = err
+        finally:
+            # the view must never stay running, or next formats wouldn't start
+            with self.lock:
+                del self.running[view_id]
+                following = self.queued.pop(view_id, None)
+                if following:
+                    self.running[view_id] = following
+
+        if following:
+            sublime.set_timeout_async(lambda: self.run(*following))
+        elif error is not None:
+            if not job.cancelled:
+                message = FORMAT_FAILED_MESSAGE.format(error)
+                sublime.set_timeout(lambda: job.view.set_status(STATUS_KEY, message))
+        elif not job.cancelled:
+            FormatJob.done[view_id] = (black, job)
+            sublime.set_timeout(
+                lambda: job.view.run_command(
+                    "black_apply", {"change_count": job.change_count}
+                )
+            )
         else:
-            LOG.debug("using black")
-            returncode, out, err = self.run_black(cmd, env, cwd, content)
+            LOG.debug("format of view %s cancelled", view_id)
+
 
-        # format/diff in editor
-        self.finalize(edit, extra, returncode, out, err, content, cmd, encoding)
+scheduler = FormatScheduler()
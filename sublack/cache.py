@@ -0,0 +1,273 @@
+"""
+Persistent cache of formatted contents.
+
+Entries are keyed by a stable digest of the content, the normalized black
+options, the [tool.black] table of pyproject.toml and the black
+executable/version, so they stay valid across sublime restarts and
+plugin_host reloads.
+"""
+import base64
+import hashlib
+import json
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+
+import sublime
+
+from .consts import (
+    PACKAGE_NAME,
+    FORMATTED_CACHE_SIZE,
+    FORMATTED_CACHE_MAX_BYTES,
+)
+
+LOG = logging.getLogger(PACKAGE_NAME)
+
+# options which don't change black's output
+IGNORED_OPTIONS = ["-", "--diff", "--quiet", "-q"]
+
+# options followed by a value
+VALUED_OPTIONS = ["-l", "--line-length", "--target-version", "-t", "--line-ranges"]
+
+
+def normalize_options(cmd):
+    """Return options of a black command line in a stable order.
+
+    The executable (cmd[0]) is not part of the result."""
+    flags = []
+    valued = []
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg in IGNORED_OPTIONS:
+            continue
+        if arg in VALUED_OPTIONS:
+            valued.append((arg, str(next(args, ""))))
+        else:
+            flags.append(arg)
+    return sorted(valued) + [(flag, "") for flag in sorted(flags)]
+
+
+def fingerprint(cmd, black_version, pyproject=None):
+    """Stable representation of everything, except the content, changing
+    black's output.
+
+    pyproject: [tool.black] table black reads besides its command line."""
+    executable, version = black_version
+    options = " ".join(k + "=" + v if v else k for k, v in normalize_options(cmd))
+    parts = [executable, version, options]
+    if pyproject:
+        parts.append(json.dumps(pyproject, sort_keys=True, default=str))
+    return "|".join(parts)
+
+
+def digest(content, cmd, black_version, pyproject=None):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    h = hashlib.sha256(fingerprint(cmd, black_version, pyproject).encode("utf-8"))
+    h.update(b"\0")
+    h.update(content)
+    return h.hexdigest()
+
+
+def compress(out):
+    return zlib.compress(out)
+
+
+def decompress(data):
+    return zlib.decompress(data)
+
+
+class FormatCache:
+    """LRU mapping content digest -> formatted output, resident in memory,
+    persisted as an append-only log.
+
+    An entry value is None when black left the content unchanged, else the
+    zlib compressed output. The cache is bounded both by number of entries
+    and by compressed bytes.
+
+    Lookups never touch the disk. New records are queued and appended to the
+    file in batch on sublime's async thread. Each line is "<key> <payload>"
+    where payload is UNCHANGED, TOUCHED (lru refresh) or the base64 of the
+    compressed output. The file is compacted when it holds too many stale
+    lines."""
+
+    UNCHANGED = "="
+    TOUCHED = "^"
+    MISSING = object()  # lookup of a key not cached
+    ENTRY_OVERHEAD = 72  # key + separators
+
+    instances = {}
+
+    def __init__(
+        self, path, size=FORMATTED_CACHE_SIZE, max_bytes=FORMATTED_CACHE_MAX_BYTES
+    ):
+        self.path = path
+        self.size = size
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.index = OrderedDict()  # least recent first
+        self.bytes = 0
+        self.pending = []
+        self.log_length = 0
+        self.log_bytes = 0
+        self.loaded = False
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        """Shared instance for path, for the life of the plugin_host"""
+        key = str(path)
+        if key not in cls.instances:
+            cls.instances[key] = cls(path, **kwargs)
+        return cls.instances[key]
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            try:
+                with self.path.open() as cache:
+                    lines = cache.read().splitlines()
+            except FileNotFoundError:
+                lines = []
+            for line in lines:
+                key, _, payload = line.partition(" ")
+                if not key:
+                    continue
+                if payload == self.TOUCHED:
+                    if key in self.index:
+                        self.index.move_to_end(key)
+                    continue
+                try:
+                    value = (
+                        None
+                        if payload in ("", self.UNCHANGED)
+                        else base64.b64decode(payload.encode("ascii"))
+                    )
+                except ValueError:
+                    LOG.debug("skipping corrupted cache line for %s", key)
+                    continue
+                self.set_value(key, value)
+            self.trim()
+            self.log_length = len(lines)
+            self.log_bytes = sum(len(line) + 1 for line in lines)
+            self.loaded = True
+
+    @classmethod
+    def entry_size(cls, value):
+        return cls.ENTRY_OVERHEAD + (len(value) if value else 0)
+
+    def set_value(self, key, value):
+        if key in self.index:
+            self.bytes -= self.entry_size(self.index.pop(key))
+        self.index[key] = value
+        self.bytes += self.entry_size(value)
+
+    def trim(self):
+        while len(self.index) > self.size or (
+            self.bytes > self.max_bytes and len(self.index) > 1
+        ):
+            key, value = self.index.popitem(last=False)
+            self.bytes -= self.entry_size(value)
+
+    def read(self):
+        """keys, most recent first"""
+        self.load()
+        with self.lock:
+            return list(reversed(self.index))
+
+    def __contains__(self, key):
+        self.load()
+        return key in self.index
+
+    def get(self, key):
+        """Return the cached output for key, None if content was unchanged.
+
+        Raise KeyError if key is not cached. The entry is marked as the most
+        recent one."""
+        value = self.lookup(key)
+        if value is self.MISSING:
+            raise KeyError(key)
+        return value
+
+    def lookup(self, key):
+        """Like get, but MISSING if key is not cached. The check and the read
+        are done at once: the entry can't be evicted in between."""
+        self.load()
+        with self.lock:
+            value = self.index.get(key, self.MISSING)
+            if value is self.MISSING:
+                return value
+            if next(reversed(self.index)) != key:
+                self.index.move_to_end(key)
+                self.queue(key + " " + self.TOUCHED)
+        return None if value is None else decompress(value)
+
+    def add(self, key, out=None):
+        """Add key (or refresh it) as the most recent one, dropping the least
+        recent. out is the formatted content, None if unchanged."""
+        self.load()
+        value = None if out is None else compress(out)
+        with self.lock:
+            if (
+                key in self.index
+                and next(reversed(self.index)) == key
+                and self.index[key] == value
+            ):
+                return False
+            self.set_value(key, value)
+            self.trim()
+            payload = (
+                self.UNCHANGED if value is None else base64.b64encode(value).decode()
+            )
+            self.queue(key + " " + payload)
+        LOG.debug("add to cache %s", key)
+        return True
+
+    def queue(self, record):
+        self.pending.append(record)
+        if len(self.pending) == 1:
+            sublime.set_timeout_async(self.flush)
+
+    def records(self):
+        """current index as log records"""
+        return [
+            k + " " + (self.UNCHANGED if v is None else base64.b64encode(v).decode())
+            for k, v in self.index.items()
+        ]
+
+    def flush(self):
+        """Write pending records to disk. Should run off the UI thread."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            pending_bytes = sum(len(r) + 1 for r in pending)
+            if (
+                self.log_length + len(pending) > 2 * self.size
+                or self.log_bytes + pending_bytes > 2 * self.max_bytes
+            ):
+                # compact: rewrite the whole index
+                lines, mode = self.records(), "w"
+            else:
+                lines, mode = pending, "a"
+            try:
+                with self.path.open(mode) as cache:
+                    cache.write("".join(r + "\n" for r in lines))
+            except OSError as err:
+                LOG.error("Unable to write cache %s: %s", self.path, err)
+                return
+            if mode == "w":
+                self.log_length = self.log_bytes = 0
+            self.log_length += len(lines)
+            self.log_bytes += sum(len(r) + 1 for r in lines)
+
+    def clear(self):
+        with self.lock:
+            self.index.clear()
+            self.bytes = 0
+            self.pending = []
+            self.log_length = self.log_bytes = 0
+            self.loaded = True
+            with self.path.open("w") as cache:
+                cache.write("")
@@ -11,12 +11,27 @@ from .consts import (
     BLACKD_ALREADY_RUNNING,
     REFORMATTED_MESSAGE,
     REFORMAT_ERRORS,
+    DISCARDED_MESSAGE,
+    FORMAT_ALL_PROGRESS,
+    FORMAT_ALL_CANCELLED,
+    FORMAT_ALL_PANEL,
+    ROOT_FILES,
 )
-from .utils import get_settings, check_blackd_on_http, get_on_save_fast, timed, popen
-from .blacker import Black
+from .utils import (
+    get_settings,
+    check_blackd_on_http,
+    get_on_save_fast,
+    find_pyproject,
+    timed,
+    RootIndex,
+)
+from .blacker import Black, FormatJob
+from .formatall import FormatAll, GitFormatAll, FileResult
+from .folding import forget_indexes
 import logging
+import os.path
+import threading
 from .server import BlackdServer
-import subprocess
 
 LOG = logging.getLogger(PACKAGE_NAME)
 
@@ -36,19 +51,59 @@ class BlackFileCommand(sublime_plugin.TextCommand):
     is_visible = is_enabled
 
     # @timed
-    def run(self, edit):
+    def run(self, edit, sync=False, on_save=False):
         LOG.debug("running black_file")
+        black = Black(self.view)
+        lines = None
+        if on_save and black.config["black_on_save_modified_only"]:
+            lines = black.modified_lines()
+
+        if black.config["black_async"] and not sync:
+            black.format_async(lines=lines)
+            return
+
         # backup view position:
         old_view_port = self.view.viewport_position()
 
-        Black(self.view)(edit)
+        black(edit, lines=lines)
 
-        # re apply view position
+        # re apply view position, moved with the text above it
         # fix : https://github.com/jgirardet/sublack/issues/52
         # not tested : view.run_command doesn't reproduce bug in tests...
-        sublime.set_timeout_async(
-            lambda: self.view.set_viewport_position(old_view_port)
-        )
+        viewport = black.viewport or old_view_port
+        sublime.set_timeout_async(lambda: self.view.set_viewport_position(viewport))
+
+
+class BlackFormatSelectionCommand(sublime_plugin.TextCommand):
+    """
+    The "black_format_selection" command formats the top level statements
+    containing the selections.
+    """
+
+    def is_enabled(self):
+        return is_python(self.view)
+
+    is_visible = is_enabled
+
+    def selected_lines(self):
+        lines = set()
+        for region in self.view.sel():
+            first = self.view.rowcol(region.begin())[0]
+            last = self.view.rowcol(region.end())[0]
+            lines.update(range(first, last + 1))
+        return sorted(lines)
+
+    def run(self, edit, sync=False):
+        LOG.debug("running black_format_selection")
+        black = Black(self.view)
+        if black.config["black_async"] and not sync:
+            black.format_async(lines=self.selected_lines())
+            return
+
+        old_view_port = self.view.viewport_position()
+        black(edit, lines=self.selected_lines())
+        viewport = black.viewport or old_view_port
+        sublime.set_timeout_async(lambda: self.view.set_viewport_position(viewport))
 
 
 class BlackDiffCommand(sublime_plugin.TextCommand):
@@ -61,9 +116,38 @@ class BlackDiffCommand(sublime_plugin.TextCommand):
 
     is_visible = is_enabled
 
-    def run(self, edit):
+    def run(self, edit, sync=False):
         LOG.debug("running black_file")
-        Black(self.view)(edit, extra=["--diff"])
+        black = Black(self.view)
+        if black.config["black_async"] and not sync:
+            black.format_async(extra=["--diff"])
+        else:
+            black(edit, extra=["--diff"])
+
+
+class BlackApplyCommand(sublime_plugin.TextCommand):
+    """
+    Apply the result of a background format, if the view didn't change
+    since the format started.
+    """
+
+    def is_visible(self):
+        return False
+
+    def run(self, edit, change_count):
+        black, job = FormatJob.done.pop(self.view.id(), (None, None))
+        if not job or job.change_count != change_count:
+            return
+
+        if self.view.change_count() != change_count:
+            LOG.debug("view changed while formatting, result discarded")
+            self.view.set_status(STATUS_KEY, DISCARDED_MESSAGE)
+            return
+
+        old_view_port = self.view.viewport_position()
+        black.apply(edit, job)
+        viewport = black.viewport or old_view_port
+        sublime.set_timeout_async(lambda: self.view.set_viewport_position(viewport))
 
 
 class BlackToggleBlackOnSaveCommand(sublime_plugin.TextCommand):
@@ -152,62 +236,206 @@ class BlackdStopCommand(sublime_plugin.ApplicationCommand):
             )
 
 
-class BlackEventListener(sublime_plugin.EventListener):
-    def on_pre_save(self, view):
-        """use blackd at saving time
+class BlackOnSaveListener(sublime_plugin.ViewEventListener):
+    """
+    Run black when a python view is saved.
+
+    Whether black runs is decided once, when the view is loaded or
+    activated, and again only after its settings or a root file changed,
+    its pyproject.toml being checked by its mtime.
+    """
+
+    # bumped when a root file is saved: every decision is stale
+    generation = 0
+
+    @classmethod
+    def is_applicable(cls, settings):
+        return "python" in settings.get("syntax", "").lower()
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.on_save = None
+        self.decided = None  # generation of the decision
+        self.pyproject = None  # (path, mtime) of the decision's pyproject.toml
+        view.settings().add_on_change("sublack_on_save", self.invalidate)
+
+    def invalidate(self):
+        self.on_save = None
+
+    def decide(self):
+        self.decided = self.generation
+        pyproject = find_pyproject(self.view)
+        self.pyproject = pyproject and (pyproject, RootIndex.get_mtime(pyproject))
+        self.on_save = get_on_save_fast(self.view)
+        return self.on_save
+
+    def is_decided(self):
+        if self.on_save is None or self.decided != self.generation:
+            return False
+        # pyproject.toml modified outside sublime
+        if self.pyproject:
+            path, mtime = self.pyproject
+            return RootIndex.get_mtime(path) == mtime
+        return True
+
+    def on_load_async(self):
+        self.decide()
+
+    def on_activated_async(self):
+        if not self.is_decided():
+            self.decide()
+
+    def on_pre_save(self):
+        """use black at saving time
 
         Cannot be async since black should be run before save"""
-        if get_on_save_fast(view):
-            view.run_command("black_file")
+        if not self.is_decided():
+            self.decide()
+        if self.on_save:
+            self.view.run_command("black_file", {"sync": True, "on_save": True})
 
+
+class BlackEventListener(sublime_plugin.EventListener):
     def on_post_text_command(self, view, command_name, args):
-        if command_name == "black_file":
+        if command_name in ["black_file", "black_apply", "black_format_selection"]:
             view.show(view.line(view.sel()[0]))
 
+    def on_close(self, view):
+        Black.formatted_texts.pop(view.id(), None)
+        forget_indexes(view)
+
+    def on_post_save(self, view):
+        filename = view.file_name()
+        if filename and os.path.basename(filename) in ROOT_FILES:
+            LOG.debug("%s saved, forgetting root files", filename)
+            RootIndex.invalidate()
+            BlackOnSaveListener.generation += 1
+
 
 class BlackFormatAllCommand(sublime_plugin.WindowCommand):
+    """
+    The "black_format_all" command formats every python file of the window's
+    folders in background. Results are streamed in the sublack output panel.
+    """
+
+    confirm_message = (
+        "Sublack: Format all?\nInfo: It runs black on every python file "
+        "of the project's folders, with sublack options and configuration."
+    )
+
+    # running formatter by window id
+    running = {}
+
     def is_enabled(self):
-        return True
+        return self.window.id() not in self.running
 
     is_visible = is_enabled
 
-    def run(self):
+    def get_formatter(self):
+        return FormatAll(self.window)
+
+    def run(self, **kwargs):
         if get_settings(self.window.active_view())["black_confirm_formatall"]:
-            if not sublime.ok_cancel_dialog(
-                "Sublack: Format all?\nInfo: It runs black without sublack "
-                "(ignoring sublack Options and Configuration)."
-            ):
+            if not sublime.ok_cancel_dialog(self.confirm_message):
                 return
 
-        folders = self.window.folders()
-
-        success = []
-        errors = []
-        dispatcher = None
-        for folder in folders:
-            p = popen(
-                ["black", "."],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                cwd=folder,
-            )
-            p.wait(timeout=10)
-            dispatcher = success if p.returncode == 0 else errors
-            dispatcher.append((folder, p.returncode, p.stderr.read()))
+        formatter = self.get_formatter(**kwargs)
+        formatter.on_result = lambda result: sublime.set_timeout(
+            lambda: self.show_result(formatter, result)
+        )
+        self.running[self.window.id()] = formatter
 
-        if not errors:  # all 0 return_code
-            self.window.active_view().set_status(STATUS_KEY, REFORMATTED_MESSAGE)
-        else:
-            self.window.active_view().set_status(STATUS_KEY, REFORMAT_ERRORS)
+        self.panel = self.window.create_output_panel(FORMAT_ALL_PANEL)
+        self.window.run_command("show_panel", {"panel": "output." + FORMAT_ALL_PANEL})
 
-        for out in success:
-            LOG.debug(
-                "black formatted folder %s with returncode %s and following en stderr :%s",
-                *out
+        # not on sublime's async thread: other sublack jobs would wait for it
+        thread = threading.Thread(target=self.run_formatter, args=(formatter,))
+        thread.daemon = True
+        thread.start()
+
+    def run_formatter(self, formatter):
+        try:
+            formatter.run()
+        finally:
+            sublime.set_timeout(lambda: self.finish(formatter))
+
+    def write(self, text):
+        self.panel.run_command(
+            "append", {"characters": text + "\n", "force": True, "scroll_to_end": True}
+        )
+
+    def set_status(self, message):
+        view = self.window.active_view()
+        if view:
+            view.set_status(STATUS_KEY, message)
+
+    def show_result(self, formatter, result):
+        if result.status == result.ERROR:
+            self.write("error: {}: {}".format(result.path, result.message))
+        elif result.status == result.REFORMATTED:
+            self.write("reformatted: {}".format(result.path))
+        self.set_status(
+            FORMAT_ALL_PROGRESS.format(
+                formatter.done, formatter.total, formatter.failed
             )
+        )
 
-        for out in errors:
-            LOG.error(
-                "black formatted folder %s with returncode %s and following en stderr :%s",
-                *out
+    def finish(self, formatter):
+        self.running.pop(self.window.id(), None)
+        results = formatter.results
+
+        if formatter.cancelled:
+            self.set_status(FORMAT_ALL_CANCELLED)
+        elif not formatter.failed:
+            self.set_status(REFORMATTED_MESSAGE)
+        else:
+            self.set_status(REFORMAT_ERRORS)
+
+        statuses = [r.status for r in results.values()]
+        self.write(
+            "{} files: {} reformatted, {} unchanged, {} failed{}".format(
+                formatter.total,
+                statuses.count(FileResult.REFORMATTED),
+                statuses.count(FileResult.UNCHANGED),
+                formatter.failed,
+                ", cancelled" if formatter.cancelled else "",
             )
+        )
+
+        for path, result in sorted(results.items()):
+            if result.status == result.ERROR:
+                LOG.error("black failed to format %s: %s", path, result.message)
+            else:
+                LOG.debug("black formatted %s: %s", path, result.status)
+
+
+class BlackFormatAllCancelCommand(sublime_plugin.WindowCommand):
+    """
+    The "black_format_all_cancel" command stops the running format all.
+    """
+
+    def is_enabled(self):
+        return self.window.id() in BlackFormatAllCommand.running
+
+    is_visible = is_enabled
+
+    def run(self):
+        formatter = BlackFormatAllCommand.running.get(self.window.id())
+        if formatter:
+            LOG.debug("cancelling format all")
+            formatter.cancel()
+
+
+class BlackFormatChangedCommand(BlackFormatAllCommand):
+    """
+    The "black_format_changed" command formats python files modified, staged
+    or untracked relative to the git ref base (HEAD by default).
+    """
+
+    confirm_message = (
+        "Sublack: Format changed files?\nInfo: It runs black on python files "
+        "modified, staged or untracked according to git."
+    )
+
+    def get_formatter(self, base="HEAD"):
+        return GitFormatAll(self.window, base=base)
@@ -13,8 +13,26 @@ ENCODING_PATTERN = r"^[ \t\v]*#.*?coding[:=][ \t]*([-_.a-zA-Z0-9]+)"
 ALREADY_FORMATTED_MESSAGE = "sublack: already well formatted"
 ALREADY_FORMATTED_MESSAGE_CACHE = "sublack (cache): already well formatted"
 
+# max number of entries of the formatted cache
+FORMATTED_CACHE_SIZE = 250
+# max size of compressed outputs kept in the formatted cache
+FORMATTED_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+# seconds root files discovery (pyproject.toml...) answers are kept
+ROOT_INDEX_TTL = 30
+# files changing the root files discovery or black on save decisions when saved
+ROOT_FILES = ["pyproject.toml", ".pre-commit-config.yaml"]
+
 REFORMATTED_MESSAGE = "sublack: reformatted"
+REFORMATTED_MESSAGE_CACHE = "sublack (cache): reformatted"
+FORMATTING_MESSAGE = "sublack: formatting..."
+FORMAT_FAILED_MESSAGE = "sublack: format failed: {}"
+DISCARDED_MESSAGE = "sublack: view changed while formatting, result discarded"
+NOTHING_TO_FORMAT_MESSAGE = "sublack: nothing to format"
 REFORMAT_ERRORS = "sublack: reformatting error, check console for logs"
+FORMAT_ALL_PROGRESS = "sublack: {}/{} files, {} failed"
+FORMAT_ALL_CANCELLED = "sublack: format all cancelled"
+FORMAT_ALL_PANEL = "sublack"
 
 CONFIG_OPTIONS = [
     "black_line_length",
@@ -32,6 +50,11 @@ CONFIG_OPTIONS = [
     "black_blackd_autostart",
     "black_use_precommit",
     "black_confirm_formatall",
+    "black_use_worker",
+    "black_mode",
+    "black_sys_path",
+    "black_async",
+    "black_on_save_modified_only",
 ]
 
 
@@ -42,6 +65,9 @@ HEADERS_TABLE = {
     "--py36": {"X-Python-Variant": "py36"},
 }
 
+# recycle the black worker after this number of formats
+BLACK_WORKER_MAX_REQUESTS = 1000
+
 BLACKD_STARTED = "blackd server started on port {}"
 BLACKD_START_FAILED = "blackd server failed to start on port {}"
 BLACKD_STOPPED = "blackd server stopped"
@@ -0,0 +1,179 @@
+"""
+Line level diff between the content before and after black.
+
+Used to apply only the changed parts of black's output to the view.
+"""
+import bisect
+import difflib
+
+import sublime
+
+
+def split_lines(text):
+    """lines of text, keeping line ends"""
+    return text.splitlines(True)
+
+
+class LineDiff:
+    """Changes from old to new text, line by line.
+
+    Lines are 0-based, like sublime's rows."""
+
+    def __init__(self, old, new):
+        self.old_lines = split_lines(old)
+        self.new_lines = split_lines(new)
+        self.opcodes = difflib.SequenceMatcher(
+            None, self.old_lines, self.new_lines, autojunk=False
+        ).get_opcodes()
+        self.changes = [op for op in self.opcodes if op[0] != "equal"]
+
+        # offset of the beginning of each line, plus end of text
+        self.old_offsets = [0]
+        for line in self.old_lines:
+            self.old_offsets.append(self.old_offsets[-1] + len(line))
+        self.new_offsets = [0]
+        for line in self.new_lines:
+            self.new_offsets.append(self.new_offsets[-1] + len(line))
+
+        self.starts = [op[1] for op in self.opcodes]
+
+    def hunks(self):
+        """(Region in old text, new text) for each change, last first so they
+        can be applied in this order without shifting the others"""
+        return [
+            (
+                sublime.Region(self.old_offsets[i1], self.old_offsets[i2]),
+                "".join(self.new_lines[j1:j2]),
+            )
+            for tag, i1, i2, j1, j2 in reversed(self.changes)
+        ]
+
+    def touches(self, first, last):
+        """True if old lines first to last (included) are modified"""
+        for tag, i1, i2, j1, j2 in self.changes:
+            if i1 == i2:  # insertion before line i1
+                if first < i1 <= last:
+                    return True
+            elif i1 <= last and i2 > first:
+                return True
+        return False
+
+    def changed_lines(self):
+        """new lines which are inserted or modified. A deletion marks the
+        line following it."""
+        lines = set()
+        last = max(len(self.new_lines) - 1, 0)
+        for tag, i1, i2, j1, j2 in self.changes:
+            lines.update(range(j1, j2) if j2 > j1 else [min(j1, last)])
+        return sorted(lines)
+
+    def map_line(self, line):
+        """new line of old line, None if the line itself changed"""
+        index = bisect.bisect_right(self.starts, line) - 1
+        if index < 0:
+            return None
+        tag, i1, i2, j1, j2 = self.opcodes[index]
+        if tag != "equal" or line >= i2:
+            return None
+        return j1 + line - i1
+
+    def new_row(self, point):
+        """new line containing new offset point"""
+        row = bisect.bisect_right(self.new_offsets, point) - 1
+        return max(min(row, len(self.new_lines) - 1), 0)
+
+    def old_row(self, point):
+        """old line containing old offset point"""
+        row = bisect.bisect_right(self.old_offsets, point) - 1
+        return max(min(row, len(self.old_lines) - 1), 0)
+
+    def map_points(self, points):
+        """new offset of each old offset, in one pass over the diff.
+
+        A point in a changed part keeps its place among the non blank
+        characters, which black doesn't reorder."""
+        mapped = [self.new_offsets[-1]] * len(points)
+        opcodes = iter(self.opcodes)
+        opcode = next(opcodes, None)
+        for index in sorted(range(len(points)), key=points.__getitem__):
+            point = points[index]
+            # first part ending after point: empty (inserting) parts are skipped
+            while opcode and self.old_offsets[opcode[2]] <= point:
+                opcode = next(opcodes, None)
+            if not opcode:
+                break
+            tag, i1, i2, j1, j2 = opcode
+            offset = point - self.old_offsets[i1]
+            if tag != "equal":
+                offset = self.map_offset(
+                    "".join(self.old_lines[i1:i2]),
+                    "".join(self.new_lines[j1:j2]),
+                    offset,
+                )
+            mapped[index] = self.new_offsets[j1] + offset
+        return mapped
+
+    @staticmethod
+    def map_offset(old, new, offset):
+        """offset in new of offset in old, counting non blank characters.
+
+        An offset just before a non blank character stays before it,
+        otherwise it stays after the previous one."""
+        count = len("".join(old[:offset].split()))
+        sticky = offset < len(old) and not old[offset].isspace()
+        if sticky:
+            count += 1
+        elif not count:
+            return min(offset, len(new) - len(new.lstrip()))
+        for position, char in enumerate(new):
+            if not char.isspace():
+                count -= 1
+                if not count:
+                    return position if sticky else position + 1
+        return len(new.rstrip("\n"))
+
+    def map_region(self, region):
+        """new Region of an old Region"""
+        a, b = self.map_points([region.a, region.b])
+        return sublime.Region(a, b)
+
+
+class ViewState:
+    """Selections and viewport of a view, remapped after a diff is applied"""
+
+    def __init__(self, view):
+        self.view = view
+        self.selections = list(view.sel())
+        self.anchor = view.visible_region().begin()
+        self.x, y = view.viewport_position()
+        # vertical position of the anchor in the viewport
+        self.offset = y - view.text_to_layout(self.anchor)[1]
+        self.viewport = None
+
+    def restore(self, diff):
+        """Remap selections and the viewport anchor with diff, all at once"""
+        points = [self.anchor]
+        for region in self.selections:
+            points.extend([region.a, region.b])
+        points = diff.map_points(points)
+
+        selection = self.view.sel()
+        selection.clear()
+        for index in range(len(self.selections)):
+            a, b = points[2 * index + 1 : 2 * index + 3]
+            selection.add(sublime.Region(a, b))
+
+        y = self.view.text_to_layout(points[0])[1] + self.offset
+        self.viewport = (self.x, y)
+        self.view.set_viewport_position(self.viewport, False)
+
+
+def apply_diff(view, edit, diff):
+    """Replace only the changed lines in view."""
+    for region, text in diff.hunks():
+        if region.empty():
+            view.insert(edit, region.begin(), text)
+        elif not text:
+            view.erase(edit, region)
+        else:
+            view.replace(edit, region, text)
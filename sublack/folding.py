@@ -1,11 +1,17 @@
 import sublime
+import hashlib
 import logging
+from collections import OrderedDict
 from .consts import PACKAGE_NAME
 
 LOG = logging.getLogger(PACKAGE_NAME)
-from .utils import popen
-import subprocess
-import json
+from .server import IndexWorker, BlackWorkerError
+from .worker import statement_lines
+
+# ast indexes by view id: {content digest: index}, most recently used last.
+# Old content of a format is usually new content of the previous one.
+_INDEXES = {}
+INDEXES_PER_VIEW = 4
 
 
 class FoldingError(Exception):
@@ -13,7 +19,7 @@ class FoldingError(Exception):
 
 
 def get_folded_lines(view):
-    """ return line number corresponding to each folded statement.
+    """return line number corresponding to each folded statement.
     Turned to 1-based to fit ast numbers."""
     return [
         view.rowcol(f.begin())[0] + 1
@@ -21,53 +27,84 @@ def get_folded_lines(view):
     ]
 
 
-def get_region_to_refold(line, view):
-    """ return a Region to fit with "left arrow click" to fold"""
-    sel = view.sel()
-    start = view.text_point(line + 1, 0)
-    sel.clear()
-    sel.add(sublime.Region(start, start))
-    view.run_command("expand_selection", args={"to": "indentation"})
-
-    region = sublime.Region(sel[0].begin() - 1, sel[0].end() - 1)
-    sel.clear()
-
-    return region
+def get_folded_regions(view):
+    """return folded regions, leaving them folded"""
+    try:
+        return view.folded_regions()  # sublime text 4
+    except AttributeError:
+        regions = view.unfold(sublime.Region(0, view.size()))
+        view.fold(regions)
+        return regions
+
+
+def indentation(text):
+    return len(text) - len(text.lstrip())
+
+
+def get_indented_block(lines, line):
+    """(first, last) lines of the block indented under line, like
+    expand_selection to indentation. None if nothing is indented under line"""
+    header = indentation(lines[line])
+    body = None
+    last = None
+    for row in range(line + 1, len(lines)):
+        text = lines[row]
+        if not text.strip():
+            continue
+        if body is None:
+            body = indentation(text)
+            if body <= header:
+                return None
+        elif indentation(text) < body:
+            break
+        last = row
+    return None if last is None else (line + 1, last)
 
 
 def get_refolds(view, to_folds):
-    """return all region to refold"""
-    return [get_region_to_refold(line, view) for line in to_folds]
+    """return all region to refold, to fit with "left arrow click" to fold.
+
+    Regions are found by scanning the indentation of view's text: the
+    selection is left untouched. None for a line with nothing indented under
+    it."""
+    lines = view.substr(sublime.Region(0, view.size())).split("\n")
+    starts = [0]
+    for text in lines:
+        starts.append(starts[-1] + len(text) + 1)
+
+    regions = []
+    for line in to_folds:
+        block = get_indented_block(lines, line) if 0 <= line < len(lines) else None
+        if block:
+            last = block[1]
+            regions.append(
+                sublime.Region(
+                    starts[line] + len(lines[line]), starts[last] + len(lines[last])
+                )
+            )
+        else:
+            regions.append(None)
+    return regions
 
 
 def get_index_with_interpreter(view, body, encoding):
-    """ extract an index for each ast node using the specified interpreter"""
+    """extract an index for each statement using the specified interpreter.
+
+    The interpreter runs as a persistent worker: no process is started to
+    refold."""
     python = view.settings().get("python_interpreter")
-    cmd = """import ast;b={};print([
-        getattr(node, "lineno", 0)
-        for node in ast.walk(ast.parse(b.decode(encoding="{}")))
-        if hasattr(node, "lineno")
-    ])""".format(
-        body, encoding
-    )
-    proc = popen([python, "-c", cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
-    if proc.returncode == 0:
-        return json.loads(out.decode())
-    else:
-        raise FoldingError(err.decode())
+    try:
+        return IndexWorker.get(python)(body, encoding)
+    except BlackWorkerError as err:
+        raise FoldingError(str(err))
 
 
 def get_index_with_python33(body):
-    """ extract an index for each ast node using the sublime python version"""
+    """extract an index for each statement using the sublime python version"""
     import ast
 
     try:
-        return [
-            getattr(node, "lineno")
-            for node in ast.walk(ast.parse(body))
-            if hasattr(node, "lineno")
-        ]
+        return statement_lines(ast.parse(body))
     except SyntaxError as err:
         LOG.error(
             """Sublack can't parse this python version to apply folding.
@@ -79,28 +116,47 @@ def get_index_with_python33(body):
 
 
 def get_ast_index(view, body, encoding):
-    """extract an index/lineno for each ast node. lineno is 1 based."""
+    """extract an index/lineno for each statement. lineno is 1 based.
+
+    Indexes are cached by view and content: already seen content is not
+    parsed again."""
+    key = hashlib.sha256(body).hexdigest()
+    indexes = _INDEXES.setdefault(view.id(), OrderedDict())
+    if key in indexes:
+        indexes.move_to_end(key)
+        return indexes[key]
 
     try:
         if view.settings().has("python_interpreter"):
-            return get_index_with_interpreter(view, body, encoding)
+            index = get_index_with_interpreter(view, body, encoding)
         else:
-            return get_index_with_python33(body)
+            index = get_index_with_python33(body)
     except FoldingError:
         return False
 
+    indexes[key] = index
+    if len(indexes) > INDEXES_PER_VIEW:
+        indexes.popitem(last=False)
+    return index
+
+
+def forget_indexes(view):
+    """Drop ast indexes cached for view, when it's closed"""
+    _INDEXES.pop(view.id(), None)
+
 
 def get_new_lines(old, new, folded_lines):
-    """get new lines comparing index. minus one a the end to 
+    """get new lines comparing index. minus one a the end to
     fit turn back to 0-based sublime line numbers"""
-    old_index = {}  # dict to not add a line twice
+    folded = set(folded_lines)
+    old_index = {}  # first position of each folded line
     for index, line in enumerate(old):
-        if line not in old_index and line in folded_lines:
+        if line in folded and line not in old_index:
             old_index[line] = index
-        if len(old_index) == len(folded_lines):
-            break
+            if len(old_index) == len(folded):
+                break
 
-    return [new[x] - 1 for x in old_index.values()]
+    return [new[x] - 1 for x in old_index.values() if x < len(new)]
 
 
 def refold_all(old, new, view, folded_lines):
@@ -108,5 +164,49 @@ def refold_all(old, new, view, folded_lines):
     # LOG.debug("old folding index/lines: %s", old)
     # LOG.debug("new new folding index/lines : %s", new)
     refolds = get_refolds(view, get_new_lines(old, new, folded_lines))
+    refolds = [region for region in refolds if region]
+    LOG.debug("new folding region: %s ", refolds)
+    view.fold(refolds)
+
+
+def unfold_changed(view, diff):
+    """Unfold folds containing changes of diff. Others are left untouched
+    since sublime keeps them while applying the diff.
+
+    Returns the unfolded regions"""
+    changed = [
+        region
+        for region in get_folded_regions(view)
+        if diff.touches(view.rowcol(region.begin())[0], view.rowcol(region.end())[0])
+    ]
+    if changed:
+        view.unfold(changed)
+    LOG.debug("folds changed by black : %s", changed)
+    return changed
+
+
+def refold_changed(view, diff, regions, old_body, new_body, encoding):
+    """Refold regions unfolded by unfold_changed once diff is applied.
+
+    The beginning of each fold is mapped with the diff, the ast index is only
+    used if nothing is indented under the mapped line."""
+    if not regions:
+        return
+
+    points = diff.map_points([region.begin() for region in regions])
+    refolds = get_refolds(view, [diff.new_row(point) for point in points])
+
+    missed = [
+        diff.old_row(region.begin()) + 1  # ast is 1-based
+        for region, refold in zip(regions, refolds)
+        if refold is None
+    ]
+    if missed:
+        old = get_ast_index(view, old_body, encoding)
+        new = get_ast_index(view, new_body, encoding)
+        if old and new:
+            refolds.extend(get_refolds(view, get_new_lines(old, new, missed)))
+
+    refolds = [region for region in refolds if region]
     LOG.debug("new folding region: %s ", refolds)
     view.fold(refolds)
@@ -0,0 +1,425 @@
+"""
+Format all python files of the window's folders.
+
+Each folder is formatted with the sublack settings resolved for it, its
+pyproject.toml included. Files are formatted in parallel and results are
+kept by file. A manifest per folder remembers verified files so only
+modified ones are formatted again.
+"""
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import threading
+import tokenize
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import sublime
+
+from .consts import PACKAGE_NAME
+from .utils import (
+    get_settings,
+    get_black_version,
+    get_matcher,
+    read_pyproject_toml,
+    cache_path,
+    popen,
+    Path,
+)
+from .blacker import get_command_line, run_formatter, Blackd
+from .server import BlackWorker
+from .cache import FormatCache, digest, fingerprint
+
+LOG = logging.getLogger(PACKAGE_NAME)
+
+
+class FileResult:
+    """Result of the format of one file"""
+
+    REFORMATTED = "reformatted"
+    UNCHANGED = "unchanged"
+    ERROR = "error"
+    CANCELLED = "cancelled"
+
+    def __init__(self, path, status, message=""):
+        self.path = path
+        self.status = status
+        self.message = message
+
+    def __repr__(self):
+        return "FileResult({}, {}, {!r})".format(self.path, self.status, self.message)
+
+
+class Manifest:
+    """Files of a folder verified by format all.
+
+    Entry by path: [size, mtime, content digest, options fingerprint]. The
+    options fingerprint includes black's executable and version and the
+    folder's [tool.black] table. Stored as json under cache_path()."""
+
+    def __init__(self, folder):
+        self.folder = str(folder)
+        name = hashlib.sha1(self.folder.encode("utf-8")).hexdigest()
+        self.path = cache_path() / "manifests" / (name + ".json")
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.seen = set()
+
+    def load(self):
+        try:
+            with self.path.open() as manifest:
+                data = json.load(manifest)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("folder") == self.folder:
+            self.entries = data.get("files", {})
+        return self
+
+    def save(self, prune=True):
+        """Write the manifest. prune: forget files not seen during this run"""
+        with self.lock:
+            files = {
+                k: v for k, v in self.entries.items() if k in self.seen or not prune
+            }
+        try:
+            if not self.path.parent.exists():
+                self.path.parent.mkdir(parents=True)
+            with self.path.open("w") as manifest:
+                json.dump({"folder": self.folder, "files": files}, manifest)
+        except OSError as err:
+            LOG.error("Unable to write manifest %s: %s", self.path, err)
+
+    @staticmethod
+    def hash(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def is_verified(self, path, stat, options):
+        """path is formatted if unchanged since last verification"""
+        key = str(path)
+        with self.lock:
+            self.seen.add(key)
+            entry = self.entries.get(key)
+        return (
+            entry is not None
+            and entry[0] == stat.st_size
+            and entry[1] == stat.st_mtime
+            and entry[3] == options
+        )
+
+    def is_known(self, path, content, options):
+        """content of path was verified, even if the file was touched"""
+        with self.lock:
+            entry = self.entries.get(str(path))
+        return (
+            entry is not None and entry[2] == self.hash(content) and entry[3] == options
+        )
+
+    def verify(self, path, content, options):
+        """path, with content, is well formatted"""
+        stat = os.stat(str(path))
+        with self.lock:
+            self.entries[str(path)] = [
+                stat.st_size,
+                stat.st_mtime,
+                self.hash(content),
+                options,
+            ]
+
+    def forget(self, path):
+        with self.lock:
+            self.entries.pop(str(path), None)
+
+
+class FormatAll:
+    """Format every python file of folders with a pool of threads.
+
+    Each file is sent to black (or blackd, the worker...) like a view would
+    be, so sublack options and the formatted cache are used.
+
+    on_result is called with each FileResult as soon as the file is done,
+    from the thread calling run. cancel can be called from any thread."""
+
+    def __init__(self, window, folders=None, workers=None, on_result=None):
+        self.window = window
+        self.on_result = on_result
+        self.folders = window.folders() if folders is None else folders
+        self.workers = workers or multiprocessing.cpu_count()
+        self.view = window.active_view()
+        self.variables = window.extract_variables()
+        self.formatted_cache = FormatCache.open(cache_path() / "formatted")
+        self.results = {}
+        self.manifests = []
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+        self.procs = set()
+        self.local = threading.local()
+        self.black_workers = []
+        self.futures = []
+        self.cancelled = False
+        self.blackd_reported = False
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+
+    # all files of the folders are listed, not a part of them
+    complete = True
+
+    def get_folder_config(self, folder):
+        """sublack settings of folder, its pyproject.toml included"""
+        pyproject = Path(folder) / "pyproject.toml"
+        if not pyproject.is_file():
+            pyproject = False
+        return get_settings(self.view, pyproject)
+
+    def get_files(self, folder):
+        return (Path(path) for path in get_matcher(folder).walk())
+
+    def get_fingerprint(self, cmd, pyproject):
+        """short fingerprint of black options, pyproject's ones included, and
+        version"""
+        text = fingerprint(cmd, get_black_version(cmd[0]), pyproject)
+        if text not in self.fingerprints:
+            self.fingerprints[text] = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return self.fingerprints[text]
+
+    def get_jobs(self):
+        """(path, cmd, config, pyproject, manifest, fingerprint) for each file
+        to format.
+
+        Files verified since their last modification are skipped"""
+        jobs = []
+        for folder in self.folders:
+            config = self.get_folder_config(folder)
+            toml = Path(folder) / "pyproject.toml"
+            pyproject = read_pyproject_toml(toml) if toml.is_file() else {}
+            manifest = Manifest(folder).load()
+            self.manifests.append(manifest)
+            for path in self.get_files(folder):
+                cmd = get_command_line(config, self.variables, str(path))
+                fingerprint = self.get_fingerprint(cmd, pyproject)
+                try:
+                    stat = os.stat(str(path))
+                except OSError:
+                    continue
+                if manifest.is_verified(path, stat, fingerprint):
+                    self.results[str(path)] = FileResult(path, FileResult.UNCHANGED)
+                else:
+                    jobs.append((path, cmd, config, pyproject, manifest, fingerprint))
+        return jobs
+
+    def run_black(self, cmd, cwd, content):
+        p = popen(
+            cmd,
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        with self.lock:
+            self.procs.add(p)
+        if self.cancelled:
+            self.kill(p)
+        try:
+            out, err = p.communicate(input=content)
+        finally:
+            with self.lock:
+                self.procs.discard(p)
+        return p.returncode, out, err
+
+    @staticmethod
+    def kill(proc):
+        if proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    def cancel(self):
+        """Stop formatting: queued files are dropped, black processes killed"""
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+        with self.lock:
+            procs = list(self.procs)
+        for proc in procs:
+            self.kill(proc)
+
+    def blackd_unreachable(self, message):
+        """blackd isn't running: tell it once per run, not for each file"""
+        with self.lock:
+            if self.blackd_reported:
+                return
+            self.blackd_reported = True
+        sublime.set_timeout(lambda: Blackd.show_unreachable(message))
+
+    def get_black_worker(self, cmd, config):
+        """Black worker of the calling thread: the shared one formats a file at
+        a time. Workers are stopped at the end of run"""
+        workers = getattr(self.local, "workers", None)
+        if workers is None:
+            workers = self.local.workers = {}
+        if cmd[0] not in workers:
+            workers[cmd[0]] = BlackWorker(cmd[0], config)
+            with self.lock:
+                self.black_workers.append(workers[cmd[0]])
+        return workers[cmd[0]]
+
+    def format_content(self, content, cmd, config, cwd, pyproject=None):
+        """Returns the Popen format: returncode(int), out(byte), err(byte)"""
+        encoding = tokenize.detect_encoding(io.BytesIO(content).readline)[0]
+        worker = None
+        if config["black_use_worker"]:
+            worker = self.get_black_worker(cmd, config)
+        return run_formatter(
+            cmd,
+            content,
+            encoding,
+            config,
+            pyproject,
+            lambda cmd, content: self.run_black(cmd, cwd, content),
+            self.blackd_unreachable,
+            worker,
+        )
+
+    def format_file(self, path, cmd, config, pyproject, manifest, fingerprint):
+        if self.cancelled:
+            return FileResult(path, FileResult.CANCELLED)
+        try:
+            with path.open("rb") as source:
+                content = source.read()
+            if manifest.is_known(path, content, fingerprint):
+                manifest.verify(path, content, fingerprint)
+                return FileResult(path, FileResult.UNCHANGED)
+
+            key = digest(content, cmd, get_black_version(cmd[0]), pyproject)
+            out = self.formatted_cache.lookup(key)
+            if out is not FormatCache.MISSING:
+                returncode, err = 0, b""
+            else:
+                returncode, out, err = self.format_content(
+                    content, cmd, config, str(path.parent), pyproject
+                )
+                if returncode == 0 and ("unchanged" in err.decode() or not out):
+                    out = None
+            if self.cancelled:
+                return FileResult(path, FileResult.CANCELLED)
+            if returncode != 0:
+                manifest.forget(path)
+                return FileResult(
+                    path, FileResult.ERROR, err.decode(errors="replace").strip()
+                )
+
+            if out is None or out == content:
+                self.formatted_cache.add(key)
+                manifest.verify(path, content, fingerprint)
+                return FileResult(path, FileResult.UNCHANGED)
+
+            with path.open("wb") as target:
+                target.write(out)
+            self.formatted_cache.add(key, out)
+            self.formatted_cache.add(
+                digest(out, cmd, get_black_version(cmd[0]), pyproject)
+            )
+            manifest.verify(path, out, fingerprint)
+            return FileResult(path, FileResult.REFORMATTED)
+
+        except Exception as err:
+            manifest.forget(path)
+            return FileResult(path, FileResult.ERROR, str(err))
+
+    def add_result(self, result):
+        if result.status == FileResult.CANCELLED:
+            return
+        self.results[str(result.path)] = result
+        self.done += 1
+        if result.status == FileResult.ERROR:
+            self.failed += 1
+        if self.on_result:
+            self.on_result(result)
+
+    def run(self):
+        """Format all files, returns results by path"""
+        jobs = self.get_jobs()
+        # already verified files count as done
+        self.done = len(self.results)
+        self.total = self.done + len(jobs)
+        workers = self.workers
+        if any(job[2]["black_mode"] == "inprocess" for job in jobs):
+            # black in process holds the GIL, threads would only wait for it
+            workers = 1
+        LOG.debug("format all: %s files, %s workers", len(jobs), workers)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                if not self.cancelled:
+                    self.futures = [pool.submit(self.format_file, *job) for job in jobs]
+                for future in as_completed(self.futures):
+                    if not future.cancelled():
+                        self.add_result(future.result())
+        finally:
+            for black_worker in self.black_workers:
+                black_worker.stop()
+        for manifest in self.manifests:
+            manifest.save(prune=self.complete)
+        return self.results
+
+    def errors(self):
+        return [r for r in self.results.values() if r.status == FileResult.ERROR]
+
+
+class GitFormatAll(FormatAll):
+    """Format only python files modified, staged or untracked relative to
+    base (a git ref)."""
+
+    complete = False
+
+    def __init__(self, window, base="HEAD", **kwargs):
+        super().__init__(window, **kwargs)
+        self.base = base
+
+    def git(self, args, cwd):
+        """Output lines of git command, raise OSError on failure"""
+        p = popen(
+            ["git"] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        out, err = p.communicate()
+        if p.returncode != 0:
+            raise OSError(err.decode(errors="replace").strip())
+        return [line for line in out.decode("utf-8").split("\0") if line]
+
+    def get_changed_files(self, folder):
+        """Changed files in folder, relative to folder with a leading "/" """
+        toplevel = self.git(["rev-parse", "--show-toplevel"], folder)[0].strip()
+        changed = self.git(
+            ["diff", "--name-only", "--diff-filter=d", "-z", self.base, "--"], toplevel
+        )
+        changed += self.git(
+            ["ls-files", "--others", "--exclude-standard", "--full-name", "-z"],
+            toplevel,
+        )
+        root = os.path.realpath(str(folder))
+        relatives = set()
+        for name in changed:
+            path = os.path.realpath(os.path.join(toplevel, name))
+            if path.startswith(root + os.sep) and os.path.isfile(path):
+                relatives.add("/" + os.path.relpath(path, root).replace(os.sep, "/"))
+        return sorted(relatives)
+
+    def get_files(self, folder):
+        matcher = get_matcher(folder)
+        try:
+            changed = self.get_changed_files(folder)
+        except OSError as err:
+            # the folder fails: a run without its files is not a success
+            self.add_result(
+                FileResult(Path(folder), FileResult.ERROR, "git failed: {}".format(err))
+            )
+            return []
+
+        return [
+            Path(str(folder), *relative.split("/")[1:])
+            for relative in changed
+            if matcher.match(relative)
+        ]
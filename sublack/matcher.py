@@ -0,0 +1,175 @@
+"""
+Which files black formats, like black's file discovery: include, exclude,
+extend-exclude and force-exclude of pyproject.toml and the root's .gitignore.
+
+Paths are relative to the root and start with "/", directories end with "/".
+
+Like black, a file given explicitly (black on save) is only checked against
+exclude and force-exclude: include, default excludes and .gitignore only
+apply to files discovered by walking the root (format all).
+"""
+import logging
+import os
+import re
+
+from .consts import PACKAGE_NAME
+
+LOG = logging.getLogger(PACKAGE_NAME)
+
+# same defaults as black
+DEFAULT_INCLUDES = r"\.pyi?$"
+DEFAULT_EXCLUDES = (
+    r"/(\.direnv|\.eggs|\.git|\.hg|\.ipynb_checkpoints|\.mypy_cache|\.nox"
+    r"|\.pytest_cache|\.tox|\.svn|\.venv|\.vscode|__pypackages__|_build"
+    r"|buck-out|build|dist|venv)/"
+)
+
+
+def compile_pattern(pattern):
+    """Compile like black does: multiline patterns are verbose"""
+    if not pattern:
+        return None
+    return re.compile(pattern, re.VERBOSE) if "\n" in pattern else re.compile(pattern)
+
+
+def translate_gitignore(line):
+    """(compiled pattern, negated) of a .gitignore line, None if the line is
+    blank or a comment"""
+    line = line.rstrip("\r\n")
+    if not line.strip() or line.startswith("#"):
+        return None
+    line = line.rstrip(" ")
+    negated = line.startswith("!")
+    if negated or line[:2] in ("\\#", "\\!"):
+        line = line[1:]
+    directory = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    anchored = "/" in line
+    line = line.lstrip("/")
+
+    regex = ""
+    index = 0
+    while index < len(line):
+        char = line[index]
+        at_start = index == 0 or line[index - 1] == "/"
+        if at_start and line.startswith("**/", index):
+            regex += "(?:.*/)?"
+            index += 3
+            continue
+        if at_start and line[index:] == "**":
+            regex += ".*"
+            index += 2
+            continue
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[" and line.find("]", index + 2) != -1:
+            end = line.find("]", index + 2)
+            content = line[index + 1 : end]
+            if content[0] in "!^":
+                content = "^" + content[1:]
+            regex += "[" + content.replace("\\", "\\\\") + "]"
+            index = end
+        elif char == "\\" and index + 1 < len(line):
+            index += 1
+            regex += re.escape(line[index])
+        else:
+            regex += re.escape(char)
+        index += 1
+
+    prefix = "^/" if anchored else "^/(?:.*/)?"
+    suffix = "/$" if directory else "/?$"
+    return re.compile(prefix + regex + suffix), negated
+
+
+class FileMatcher:
+    """Patterns of a root compiled once, verdicts cached by path.
+
+    A matcher is built again when pyproject.toml or .gitignore changes (see
+    utils.get_matcher)."""
+
+    def __init__(self, root, options=None, gitignore=()):
+        """options: black's options from pyproject.toml. gitignore: lines of
+        the root's .gitignore, used only without exclude option like black."""
+        options = options or {}
+        self.root = str(root)
+        self.realroot = os.path.realpath(self.root)
+        self.include = compile_pattern(options.get("include") or DEFAULT_INCLUDES)
+        exclude = options.get("exclude")
+        patterns = [
+            exclude or DEFAULT_EXCLUDES,
+            options.get("extend-exclude"),
+            options.get("force-exclude"),
+        ]
+        self.excludes = [compile_pattern(p) for p in patterns if p]
+        # patterns applying to a file given explicitly
+        self.explicit_excludes = [
+            compile_pattern(p) for p in [exclude, options.get("force-exclude")] if p
+        ]
+        self.ignores = []
+        if not exclude:
+            self.ignores = [p for p in map(translate_gitignore, gitignore) if p]
+        self.excluded_dirs = {}
+        self.verdicts = {}
+
+    def relative(self, path):
+        """path relative to root starting with "/", None if not under root"""
+        path = os.path.realpath(str(path))
+        if not path.startswith(self.realroot.rstrip(os.sep) + os.sep):
+            return None
+        return "/" + os.path.relpath(path, self.realroot).replace(os.sep, "/")
+
+    def is_excluded(self, relative):
+        """relative itself (not its parents) is excluded or ignored by git"""
+        if any(exclude.search(relative) for exclude in self.excludes):
+            return True
+        ignored = False
+        for pattern, negated in self.ignores:
+            if pattern.search(relative):
+                ignored = not negated
+        return ignored
+
+    def is_dir_excluded(self, relative):
+        """relative: a directory ending with "/". Parents are checked too"""
+        verdict = self.excluded_dirs.get(relative)
+        if verdict is None:
+            parent = relative[: relative.rstrip("/").rfind("/") + 1]
+            verdict = (parent != "/" and self.is_dir_excluded(parent)) or (
+                self.is_excluded(relative)
+            )
+            self.excluded_dirs[relative] = verdict
+        return verdict
+
+    def match(self, relative):
+        """Whether black formats the file relative"""
+        verdict = self.verdicts.get(relative)
+        if verdict is None:
+            parent = relative[: relative.rfind("/") + 1]
+            verdict = (
+                not (parent != "/" and self.is_dir_excluded(parent))
+                and bool(self.include.search(relative))
+                and not self.is_excluded(relative)
+            )
+            self.verdicts[relative] = verdict
+        return verdict
+
+    def match_file(self, relative):
+        """Whether black on save formats the file relative, given explicitly"""
+        return not any(exclude.search(relative) for exclude in self.explicit_excludes)
+
+    def walk(self):
+        """Paths of the files black formats under root, sorted by directory"""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            base = os.path.relpath(dirpath, self.root).replace(os.sep, "/")
+            base = "" if base == "." else "/" + base
+            dirnames[:] = sorted(
+                dirname
+                for dirname in dirnames
+                if not self.is_dir_excluded(base + "/" + dirname + "/")
+            )
+            for filename in sorted(filenames):
+                if self.match(base + "/" + filename):
+                    yield os.path.join(dirpath, filename)
@@ -0,0 +1,143 @@
+"""
+Run the black hook of .pre-commit-config.yaml without pre-commit.
+
+pre-commit installs hook repositories in its cache and records them in a
+sqlite database. Black installed there is run directly through stdin, like
+black_command, so pre-commit's startup and temporary files are avoided.
+"""
+import glob
+import logging
+import os
+import shlex
+
+try:
+    import sqlite3
+except ImportError:  # not shipped with sublime text 3's python
+    sqlite3 = None
+
+from .consts import PACKAGE_NAME
+
+LOG = logging.getLogger(PACKAGE_NAME)
+
+# black executables resolved by (repo, rev, additional dependencies,
+# language_version)
+_RESOLVED = {}
+
+
+def cache_dir():
+    """pre-commit's cache folder, looked up like pre-commit does"""
+    if os.environ.get("PRE_COMMIT_HOME"):
+        return os.environ["PRE_COMMIT_HOME"]
+    xdg = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(xdg, "pre-commit")
+
+
+def black_hook(config):
+    """(repo, hook) of black in a parsed .pre-commit-config.yaml, None if
+    there is none"""
+    if not isinstance(config, dict):
+        return None
+    for repo in config.get("repos") or []:
+        for hook in repo.get("hooks") or []:
+            if hook.get("id") == "black":
+                return repo, hook
+    return None
+
+
+class PreCommitConfig:
+    """What sublack needs of a parsed .pre-commit-config.yaml: whether black
+    is used and its hook"""
+
+    def __init__(self, config):
+        found = black_hook(config)
+        repo, self.hook = found or ({}, {})
+        self.repo = repo.get("repo")
+        self.rev = None if repo.get("rev") is None else str(repo["rev"])
+        self.args = [str(arg) for arg in self.hook.get("args") or []]
+        repos = config.get("repos") if isinstance(config, dict) else None
+        self.uses_black = bool(found) or any(
+            repo.get("repo") == "https://github.com/ambv/black" for repo in repos or []
+        )
+
+
+def repo_path(repo, rev, dependencies=()):
+    """Folder where pre-commit installed repo at rev, None if unknown"""
+    db = os.path.join(cache_dir(), "db.db")
+    if sqlite3 is None or not os.path.isfile(db):
+        return None
+    if dependencies:
+        # pre-commit's name for a repo with additional dependencies
+        repo = "{}:{}".format(repo, ",".join(dependencies))
+    try:
+        connection = sqlite3.connect(db)
+        try:
+            row = connection.execute(
+                "SELECT path FROM repos WHERE repo = ? AND ref = ?", (repo, rev)
+            ).fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error as err:
+        LOG.debug("can't read pre-commit database %s: %s", db, err)
+        return None
+    return row[0] if row else None
+
+
+def black_executable(path, language_version=None):
+    """black of the python environment pre-commit created in path"""
+    envs = sorted(glob.glob(os.path.join(path, "py_env-*")))
+    if language_version:
+        preferred = os.path.join(path, "py_env-" + language_version)
+        envs.sort(key=lambda env: env != preferred)
+    for env in envs:
+        for executable in [
+            os.path.join(env, "bin", "black"),
+            os.path.join(env, "Scripts", "black.exe"),
+        ]:
+            if os.path.isfile(executable):
+                return executable
+    return None
+
+
+class PreCommitBlack:
+    """black of a pre-commit hook: executable and args"""
+
+    def __init__(self, executable, args):
+        self.executable = executable
+        self.args = list(args)
+
+    def __repr__(self):
+        return "PreCommitBlack({!r}, {!r})".format(self.executable, self.args)
+
+    def get_command_line(self, filename=None, extra=[]):
+        cmd = [self.executable, "-"] + list(extra) + self.args
+        if filename and filename.endswith(".pyi") and "--pyi" not in cmd:
+            cmd.append("--pyi")
+        return cmd
+
+
+def resolve(config):
+    """PreCommitBlack of the black hook of a PreCommitConfig.
+
+    None if black can't be run without pre-commit: no black hook, hook not
+    installed yet, no sqlite3..."""
+    hook = config.hook
+    if not hook:
+        return None
+
+    if config.repo == "local":
+        if hook.get("language") != "system" or not hook.get("entry"):
+            return None
+        entry = shlex.split(hook["entry"])
+        return PreCommitBlack(entry[0], entry[1:] + config.args)
+
+    dependencies = tuple(hook.get("additional_dependencies") or [])
+    key = (config.repo, config.rev, dependencies, hook.get("language_version"))
+    executable = _RESOLVED.get(key)
+    if executable is None or not os.path.isfile(executable):
+        path = repo_path(config.repo, config.rev, dependencies)
+        executable = path and black_executable(path, key[3])
+        if not executable:
+            LOG.debug("black hook of %s not installed by pre-commit", config.repo)
+            return None
+        _RESOLVED[key] = executable
+    return PreCommitBlack(executable, config.args)
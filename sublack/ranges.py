@@ -0,0 +1,109 @@
+"""
+Range formatting: find top level statements to format only a part of a file.
+
+Lines are 0-based, like sublime's rows.
+"""
+import io
+import logging
+import re
+import tokenize
+
+from .consts import PACKAGE_NAME
+
+LOG = logging.getLogger(PACKAGE_NAME)
+
+# keywords continuing the previous top level statement
+CONTINUATIONS = ["else", "elif", "except", "finally"]
+
+# first black version supporting --line-ranges
+LINE_RANGES_VERSION = (23, 11)
+
+
+def supports_line_ranges(black_version):
+    """black_version: string returned by get_black_version"""
+    found = re.search(r"(\d+)\.(\d+)", black_version)
+    if not found:
+        return False
+    return tuple(int(x) for x in found.groups()) >= LINE_RANGES_VERSION
+
+
+def top_level_blocks(text):
+    """(first, last) lines of each top level statement, decorators and
+    trailing comments included, trailing blank lines excluded.
+
+    Raises tokenize.TokenError or SyntaxError (IndentationError) if text
+    can't be tokenized."""
+    lines = text.splitlines()
+    starts = []
+    depth = 0
+    new_statement = True
+    decorator = False
+    for tok in tokenize.generate_tokens(io.StringIO(text).readline):
+        kind, string, start = tok[0], tok[1], tok[2]
+        if kind == tokenize.INDENT:
+            depth += 1
+        elif kind == tokenize.DEDENT:
+            depth -= 1
+        elif kind == tokenize.NEWLINE:
+            new_statement = True
+        elif kind in (tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER):
+            continue
+        elif new_statement:
+            new_statement = False
+            if depth == 0 and not decorator and string not in CONTINUATIONS:
+                starts.append(start[0] - 1)
+            if depth == 0:
+                decorator = string == "@"
+
+    blocks = []
+    for index, first in enumerate(starts):
+        last = starts[index + 1] - 1 if index + 1 < len(starts) else len(lines) - 1
+        while last > first and not lines[last].strip():
+            last -= 1
+        blocks.append((first, last))
+    return blocks
+
+
+def blocks_for_lines(blocks, lines):
+    """Blocks containing any of lines, adjacent blocks merged"""
+    lines = sorted(set(lines))
+    selected = []
+    for first, last in blocks:
+        if any(first <= line <= last for line in lines):
+            if selected and selected[-1][1] + 1 >= first:
+                selected[-1] = (selected[-1][0], last)
+            else:
+                selected.append((first, last))
+    return selected
+
+
+def line_ranges_args(blocks):
+    """black's --line-ranges arguments (1-based)"""
+    args = []
+    for first, last in blocks:
+        args.extend(["--line-ranges", "{}-{}".format(first + 1, last + 1)])
+    return args
+
+
+def splice(text, blocks, formatted):
+    """Replace each block of text by its formatted version.
+
+    formatted: list of formatted texts, same order as blocks"""
+    lines = text.splitlines(True)
+    for (first, last), new in reversed(list(zip(blocks, formatted))):
+        if lines[last : last + 1] and not lines[last].endswith("\n"):
+            new = new.rstrip("\n")
+        lines[first : last + 1] = [new]
+    return "".join(lines)
+
+
+def without_line_ranges(cmd):
+    """cmd without its --line-ranges arguments"""
+    result = []
+    args = iter(cmd)
+    for arg in args:
+        if arg == "--line-ranges":
+            next(args, None)
+        else:
+            result.append(arg)
+    return result
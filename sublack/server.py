@@ -1,3 +1,4 @@
+import json
 import subprocess
 import sublime
 import requests
@@ -5,6 +6,7 @@ import time
 import os
 import sys
 import tempfile
+import threading
 import logging
 from .utils import (
     cache_path,
@@ -13,8 +15,11 @@ from .utils import (
     get_open_port,
     check_blackd_on_http,
     get_python3_executable,
+    get_black_interpreter,
+    get_black_version,
 )
-from .consts import PACKAGE_NAME
+from .consts import PACKAGE_NAME, BLACK_WORKER_MAX_REQUESTS
+from . import worker
 
 LOG = logging.getLogger(PACKAGE_NAME)
 
@@ -195,3 +200,189 @@ class BlackdServer:
             return pid
         else:
             LOG.error("No blackd deamon could be stop since no pid cached")
+
+
+class BlackWorkerError(Exception):
+    pass
+
+
+class BlackWorker:
+    """Persistent black process speaking sublack's worker protocol.
+
+    The worker is started with the interpreter of black_command and imports
+    black once. It is restarted if it crashes, after BLACK_WORKER_MAX_REQUESTS
+    requests or if black is upgraded. A worker which can't start is not
+    started again until black or the settings change."""
+
+    instances = {}
+
+    def __init__(self, black_command, settings=None, max_requests=None):
+        self.black_command = black_command
+        self.settings = settings
+        self.max_requests = max_requests or BLACK_WORKER_MAX_REQUESTS
+        self.proc = None
+        self.requests = 0
+        self.black_version = None
+        self.failure = None  # (state, message) of a worker which can't start
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, black_command, settings=None):
+        """Shared worker for black_command, for the life of the plugin_host"""
+        if black_command not in cls.instances:
+            cls.instances[black_command] = cls(black_command, settings=settings)
+        instance = cls.instances[black_command]
+        if settings is not None and settings != instance.settings:
+            instance.settings = settings
+            instance.failure = None
+        return instance
+
+    @classmethod
+    def stop_all(cls):
+        for instance in cls.instances.values():
+            instance.stop()
+        cls.instances.clear()
+
+    @property
+    def script(self):
+        """worker.py path. Copied to cache since sublack may be zipped"""
+        path = cache_path() / "worker.py"
+        if not path.parent.exists():
+            path.parent.mkdir()
+        source = sublime.load_resource("Packages/sublack/sublack/worker.py")
+        if not path.is_file() or path.read_text() != source:
+            path.write_text(source)
+        return str(path)
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def needs_recycle(self):
+        if self.requests >= self.max_requests:
+            LOG.debug("black worker recycled after %s requests", self.requests)
+            return True
+        if get_black_version(self.black_command) != self.black_version:
+            LOG.debug("black version changed, recycling worker")
+            return True
+        return False
+
+    def state(self):
+        """What a failure to start depends on"""
+        return get_black_version(self.black_command)
+
+    def get_command(self):
+        python = get_black_interpreter(self.black_command, self.settings)
+        if not python:
+            raise BlackWorkerError("No interpreter found for black worker")
+        self.black_version = get_black_version(self.black_command)
+        return [python, "-u", self.script]
+
+    def start(self):
+        cmd = self.get_command()
+        LOG.debug("Starting black worker with args %s", cmd)
+        self.proc = popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.requests = 0
+        LOG.info("black worker running with pid %s", self.proc.pid)
+
+    def stop(self):
+        """Stop the worker, returns what it wrote to stderr"""
+        if self.proc is None:
+            return ""
+        try:
+            self.proc.stdin.close()  # worker exits at EOF
+            self.proc.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+        try:
+            err = self.proc.stderr.read().decode(errors="replace")
+            self.proc.stderr.close()
+        except (OSError, ValueError):
+            err = ""
+        LOG.debug("black worker stopped")
+        self.proc = None
+        return err
+
+    def request(self, header, body):
+        if not self.is_running() or self.needs_recycle():
+            self.stop()
+            self.start()
+        self.requests += 1
+        worker.write_message(self.proc.stdin, header, body)
+        return worker.read_message(self.proc.stdout)
+
+    def send(self, header, body):
+        """Return the (header, body) response, the worker is restarted once if
+        it crashed"""
+        with self.lock:
+            if self.failure is not None:
+                if self.failure[0] == self.state():
+                    raise BlackWorkerError(self.failure[1])
+                self.failure = None
+            for attempt in range(2):
+                try:
+                    return self.request(header, body)
+                except (OSError, EOFError, ValueError) as err:
+                    # crashed: restart on next attempt
+                    LOG.error("black worker failed: %s", err)
+                    proc, first = self.proc, self.requests <= 1
+                    stderr = self.stop().strip()
+                    if first and proc is not None and proc.returncode > 0:
+                        # exited before its first answer: it can't start
+                        message = "black worker can't start: {}".format(
+                            stderr or err
+                        )
+                        self.failure = (self.state(), message)
+                        raise BlackWorkerError(message)
+
+        raise BlackWorkerError("black worker is not able to run")
+
+    def __call__(self, args, content, config=None):
+        """Format content with black's args. config: [tool.black] table of
+        pyproject.toml, read by black's command line too.
+
+        Returns the Popen format: returncode(int), out(byte), err(byte).
+        Raises BlackWorkerError if the worker can't apply an option."""
+        header = {"action": "format", "args": args, "config": config or {}}
+        response, out = self.send(header, content)
+        if response.get("unsupported"):
+            raise BlackWorkerError("black worker: {}".format(response["err"]))
+        return response["returncode"], out, response["err"].encode()
+
+
+class IndexWorker(BlackWorker):
+    """Persistent python_interpreter process giving ast indexes to refold.
+
+    Same worker as BlackWorker but black is not imported, so any python 3
+    can run it."""
+
+    instances = {}
+
+    def __init__(self, python, settings=None, max_requests=None):
+        super().__init__(python, settings, max_requests)
+        self.python = python
+
+    def state(self):
+        return self.python
+
+    def get_command(self):
+        return [self.python, "-u", self.script, "--index"]
+
+    def needs_recycle(self):
+        if self.requests >= self.max_requests:
+            LOG.debug("index worker recycled after %s requests", self.requests)
+            return True
+        return False
+
+    def __call__(self, content, encoding):
+        """1-based line number of each ast node of content. Raise
+        BlackWorkerError if content can't be parsed"""
+        response, out = self.send({"action": "index", "encoding": encoding}, content)
+        if response["returncode"] != 0:
+            raise BlackWorkerError(response["err"])
+        return json.loads(out.decode())
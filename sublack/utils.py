@@ -7,14 +7,21 @@ from .consts import (
     PACKAGE_NAME,
     SETTINGS_FILE_NAME,
     SETTINGS_NS_PREFIX,
+    ROOT_INDEX_TTL,
 )
+from .cache import FormatCache
+from .matcher import FileMatcher
+from .precommit import PreCommitConfig
 
 import pathlib
 import subprocess
+import shutil
+import sys
 import signal
 import os
 import locale
 import socket
+import time
 import requests
 import logging
 import yaml
@@ -60,20 +67,16 @@ def timed(fn):
 
 def match_exclude(view):
     pyproject = find_pyproject(view)
-    if pyproject:
-        excluded = read_pyproject_toml(pyproject).get("exclude", None)
-        if excluded:
-            cur_fil = Path(view.file_name())
-            try:
-                rel_path = cur_fil.relative_to(pyproject.parent)
-            except ValueError:
-                LOG.debug("%s not in %s", cur_fil, pyproject.parent)
-                return
+    if pyproject and view.file_name():
+        matcher = get_matcher(pyproject.parent)
+        rel_path = matcher.relative(view.file_name())
+        if rel_path is None:
+            LOG.debug("%s not in %s", view.file_name(), pyproject.parent)
+            return
 
-            else:
-                if re.match(excluded, "/" + str(rel_path), re.VERBOSE):
-                    LOG.info("%s excluded from pyproject, aborting", rel_path)
-                    return True
+        if not matcher.match_file(rel_path):
+            LOG.info("%s excluded from pyproject, aborting", rel_path)
+            return True
 
 
 def get_on_save_fast(view):
@@ -92,11 +95,15 @@ def get_on_save_fast(view):
     return sublime.load_settings(SETTINGS_FILE_NAME).get("black_on_save")
 
 
-def get_settings(view):
-    flat_settings = view.settings()
+def get_settings(view, pyproject=None):
+    """pyproject: pyproject.toml to use instead of the view's one, False for
+    none. view may be None to ignore view's settings."""
+    flat_settings = view.settings() if view else {}
     nested_settings = flat_settings.get(PACKAGE_NAME, {})
     global_settings = sublime.load_settings(SETTINGS_FILE_NAME)
-    pyproject_settings = read_pyproject_toml(find_pyproject(view))
+    if pyproject is None and view:
+        pyproject = find_pyproject(view)
+    pyproject_settings = read_pyproject_toml(pyproject)
     settings = {}
 
     for k in CONFIG_OPTIONS:
@@ -223,6 +230,42 @@ def check_blackd_on_http(port, host="localhost"):
             return False, False
 
 
+class RootIndex:
+    """Memoized answers of root files discovery (pyproject.toml, pre-commit
+    config...), shared by all views.
+
+    An answer is trusted for ROOT_INDEX_TTL seconds, a found file being
+    checked by its mtime (deleted or modified: search again). Everything is
+    forgotten when a root file is saved in sublime."""
+
+    answers = {}  # key: (path, mtime, time)
+
+    @staticmethod
+    def get_mtime(path):
+        try:
+            return os.stat(str(path)).st_mtime
+        except OSError:
+            return None
+
+    @classmethod
+    def get(cls, key, search):
+        """Answer for key, search() is called if not known"""
+        now = time.time()
+        answer = cls.answers.get(key)
+        if answer and now - answer[2] < ROOT_INDEX_TTL:
+            path, mtime, _ = answer
+            if path is None or cls.get_mtime(path) == mtime:
+                return path
+
+        path = search()
+        cls.answers[key] = (path, cls.get_mtime(path) if path else None, now)
+        return path
+
+    @classmethod
+    def invalidate(cls):
+        cls.answers.clear()
+
+
 def find_root_file(view, filename):
     """Only search in projects and folders since pyproject.toml/precommit, ... should be nowhere else"""
     window = view.window()
@@ -230,11 +273,19 @@ def find_root_file(view, filename):
     filepath = window.extract_variables().get("file_path", None)
     if not filepath:
         return
+    folders = window.folders()
+    return RootIndex.get(
+        ("root_file", filename, filepath, tuple(folders)),
+        lambda: search_root_file(filepath, folders, filename),
+    )
+
+
+def search_root_file(filepath, window_folders, filename):
     filepath = Path(filepath)
 
     # folders
     folders = []
-    for f in window.folders():
+    for f in window_folders:
         p = Path(f)
         if p in filepath.parents:
             folders.append(p)
@@ -259,6 +310,20 @@ def find_root_file(view, filename):
 
 
 def find_pyproject(view):
+    try:
+        fname = view.file_name()
+    except AttributeError:
+        fname = None
+    if not fname:
+        return search_pyproject(view)
+
+    return RootIndex.get(
+        ("pyproject", fname, tuple(view.window().folders())),
+        lambda: search_pyproject(view),
+    )
+
+
+def search_pyproject(view):
     pyproject = find_root_file(view, "pyproject.toml")
     if pyproject:
         return pyproject
@@ -289,21 +354,104 @@ def find_pyproject(view):
             return None
 
 
+# parsed pyproject by resolved path: (mtime, size, config)
+_PYPROJECTS = {}
+# FileMatcher by resolved root: (pyproject and .gitignore (mtime, size), matcher)
+_MATCHERS = {}
+# black hook of .pre-commit-config.yaml by resolved path: (mtime, size, config)
+_PRE_COMMIT_CONFIGS = {}
+
+
 def read_pyproject_toml(pyproject: Path) -> dict:
-    """Return config options foud in pyproject"""
+    """Return config options foud in pyproject
+
+    Parsed config is cached until pyproject's mtime or size changes."""
     config = {}
     if not pyproject:
         LOG.debug("No pyproject.toml file found")
         return {}
 
+    path = os.path.realpath(str(pyproject))
     try:
-        pyproject_toml = toml.load(str(pyproject))
+        stat = os.stat(path)
+    except OSError:
+        _PYPROJECTS.pop(path, None)
+        LOG.error("Error reading configuration file: %s", pyproject)
+        return {}
+
+    cached = _PYPROJECTS.get(path)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return dict(cached[2])
+
+    try:
+        pyproject_toml = toml.load(path)
         config = pyproject_toml.get("tool", {}).get("black", {})
     except (toml.TomlDecodeError, OSError) as e:
         LOG.error("Error reading configuration file: %s", pyproject)
         # pass
 
     # LOG.debug("config values extracted from %s : %r", pyproject, config)
+    _PYPROJECTS[path] = (stat.st_mtime, stat.st_size, config)
+    return dict(config)
+
+
+def get_matcher(root):
+    """FileMatcher of root's pyproject.toml and .gitignore.
+
+    Built again only when one of them is modified, so verdicts are kept."""
+    root = Path(str(root))
+    key = []
+    for name in ("pyproject.toml", ".gitignore"):
+        try:
+            stat = (root / name).stat()
+        except OSError:
+            key.append(None)
+        else:
+            key.append((stat.st_mtime, stat.st_size))
+    key = tuple(key)
+
+    path = os.path.realpath(str(root))
+    cached = _MATCHERS.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    options = read_pyproject_toml(root / "pyproject.toml") if key[0] else {}
+    gitignore = []
+    if key[1]:
+        try:
+            with (root / ".gitignore").open(encoding="utf-8", errors="replace") as f:
+                gitignore = f.read().splitlines()
+        except OSError:
+            LOG.error("Error reading %s", root / ".gitignore")
+    matcher = FileMatcher(root, options, gitignore)
+    _MATCHERS[path] = (key, matcher)
+    return matcher
+
+
+def read_pre_commit_config(precommit: Path) -> PreCommitConfig:
+    """black's hook found in .pre-commit-config.yaml
+
+    Cached until precommit's mtime or size changes."""
+    path = os.path.realpath(str(precommit))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        _PRE_COMMIT_CONFIGS.pop(path, None)
+        LOG.error("Error reading configuration file: %s", precommit)
+        return PreCommitConfig(None)
+
+    cached = _PRE_COMMIT_CONFIGS.get(path)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+
+    try:
+        config = PreCommitConfig(
+            yaml.load(Path(path).read_text(), Loader=yaml.FullLoader)
+        )
+    except (yaml.YAMLError, OSError):
+        LOG.error("Error reading configuration file: %s", precommit)
+        config = PreCommitConfig(None)
+    _PRE_COMMIT_CONFIGS[path] = (stat.st_mtime, stat.st_size, config)
     return config
 
 
@@ -314,27 +462,120 @@ def use_pre_commit(precommit: Path) -> bool:
         LOG.debug("No .pre-commit-config.yaml f ile found")
         return False
 
-    config = yaml.load(precommit.read_text(), Loader=yaml.FullLoader)
-    if not config:
-        return False
+    if read_pre_commit_config(precommit).uses_black:
+        return precommit
 
-    if "repos" not in config:
-        LOG.debug('.pre-commit-config.yaml has no "repos"')
-        return False
+    return False
 
-    for repo in config["repos"]:
-        if "https://github.com/ambv/black" == repo["repo"]:
-            return precommit
-        for hooks in repo["hooks"]:
-            if hooks["id"] == "black":
-                return precommit
 
-    return False
+_BLACK_VERSIONS = {}
+
+
+def get_black_version(black_command):
+    """Return black's version string for black_command.
+
+    Result is memoized per resolved executable and its mtime so black is only
+    spawned once per session and again after an upgrade."""
+    executable = shutil.which(black_command) or black_command
+    try:
+        mtime = os.stat(executable).st_mtime
+    except OSError:
+        mtime = None
+
+    key = (executable, mtime)
+    if key not in _BLACK_VERSIONS:
+        try:
+            out = subprocess.check_output(
+                [black_command, "--version"],
+                stderr=subprocess.STDOUT,
+                startupinfo=startup_info(),
+                env=get_env(),
+            )
+            version = out.decode().strip().splitlines()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError) as err:
+            LOG.debug("get_black_version: unable to get version: %s", err)
+            version = ""
+        LOG.debug("black version for %s : %s", executable, version)
+        _BLACK_VERSIONS[key] = version
+
+    return executable, _BLACK_VERSIONS[key]
+
+
+def parse_black_version(version):
+    """version number in a get_black_version string: "22.3.0" for "black,
+    22.3.0 (compiled: yes)". None if not found"""
+    found = re.search(r"\b(\d+\.\d+\S*)", version)
+    return found.group(1).rstrip(",;)") if found else None
+
+
+def get_black_interpreter(black_command, config=None):
+    """Find the python interpreter black_command is installed with.
+
+    Look at black's shebang then next to black's executable, then fallback to
+    get_python3_executable."""
+    executable = shutil.which(black_command)
+    if executable:
+        try:
+            with open(executable, "rb") as black_file:
+                first_line = black_file.readline(1024)
+        except OSError:
+            first_line = b""
+        if first_line.startswith(b"#!"):
+            shebang = first_line[2:].decode(errors="ignore").strip().split()
+            if shebang and Path(shebang[0]).name == "env":
+                shebang = shebang[1:]
+            if shebang and "python" in Path(shebang[0]).name:
+                LOG.debug("black interpreter from shebang: %s", shebang[0])
+                return shebang[0]
+
+        folder = Path(executable).parent
+        for candidate in [
+            folder / "python",
+            folder / "python.exe",
+            folder.parent / "python.exe",  # windows: Scripts\black.exe
+        ]:
+            if candidate.is_file():
+                LOG.debug("black interpreter next to black: %s", candidate)
+                return str(candidate)
+
+    return get_python3_executable(config)
+
+
+_BLACK_MODULES = {}
+
+
+def import_black(sys_path=None):
+    """Return black module if it's importable by sublime's python, else None.
+
+    sys_path: extra folders added to sys.path to find black."""
+    key = tuple(sys_path or ())
+    if key not in _BLACK_MODULES:
+        for folder in key:
+            if folder not in sys.path:
+                sys.path.append(folder)
+        try:
+            import black
+        except Exception as err:  # ImportError, or SyntaxError with old python
+            LOG.debug("black can't be imported: %r", err)
+            black = None
+        else:
+            if not all(
+                hasattr(black, attr)
+                for attr in ["format_file_contents", "NothingChanged", "TargetVersion"]
+            ):
+                LOG.debug("imported black %s is too old", black.__version__)
+                black = None
+        _BLACK_MODULES[key] = black
+    return _BLACK_MODULES[key]
 
 
 def clear_cache():
-    with (cache_path() / "formatted").open("wt") as file:
-        file.write("")
+    FormatCache.open(cache_path() / "formatted").clear()
+    _PYPROJECTS.clear()
+    _MATCHERS.clear()
+    _PRE_COMMIT_CONFIGS.clear()
+    RootIndex.invalidate()
+    shutil.rmtree(str(cache_path() / "manifests"), ignore_errors=True)
 
 
 def is_python3_executable(python_executable, default_shell=None):
@@ -0,0 +1,327 @@
+"""
+Long-lived black worker.
+
+Run with the interpreter black is installed in. Black is imported once then
+format requests are served over stdin/stdout.
+
+Protocol: every message is made of frames, a frame being a 4 bytes big-endian
+length followed by the payload.
+    request: json header frame {"action": "format", "args": [...],
+        "config": {...}}, content frame
+    response: json header frame {"returncode": int, "err": str}, output frame
+
+config is the [tool.black] table of pyproject.toml, which `black -` reads too.
+If args or config hold an option the worker can't apply, the response header
+has "unsupported": true and black's command line must be used instead.
+
+The "index" action ({"action": "index", "encoding": str}) answers with the
+json list of the line numbers of content's statements, used to refold. Started
+with --index, the worker doesn't import black and only serves indexes.
+
+This module must not import sublime: it runs outside of sublime_text.
+"""
+import ast
+import io
+import json
+import struct
+import sys
+import tokenize
+
+HEADER = struct.Struct(">I")
+
+# same messages as black's command line
+REFORMATTED = "1 file reformatted."
+UNCHANGED = "1 file left unchanged."
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class UnsupportedOption(ProtocolError):
+    """black option the worker can't apply like black's command line"""
+
+
+def read_exactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError("stream closed")
+        data += chunk
+    return data
+
+
+def read_frame(stream):
+    (size,) = HEADER.unpack(read_exactly(stream, HEADER.size))
+    return read_exactly(stream, size)
+
+
+def write_frame(stream, data):
+    stream.write(HEADER.pack(len(data)) + data)
+
+
+def read_message(stream):
+    """Return (header, body)"""
+    header = json.loads(read_frame(stream).decode("utf-8"))
+    return header, read_frame(stream)
+
+
+def write_message(stream, header, body=b""):
+    write_frame(stream, json.dumps(header).encode("utf-8"))
+    write_frame(stream, body)
+    stream.flush()
+
+
+# options which don't change black's output
+QUIET_OPTIONS = ("-q", "--quiet", "-v", "--verbose")
+
+# [tool.black] keys which don't change the output of `black -`
+IGNORED_CONFIG = (
+    "include",
+    "exclude",
+    "extend-exclude",
+    "force-exclude",
+    "quiet",
+    "verbose",
+    "color",
+    "workers",
+)
+
+
+def split_args(args):
+    """black args with "--option=value" and "-l88" split in two"""
+    for arg in args:
+        if arg.startswith("--") and "=" in arg:
+            option, _, value = arg.partition("=")
+            yield option
+            yield value
+        elif arg[:2] in ("-l", "-t") and len(arg) > 2:
+            yield arg[:2]
+            yield arg[2:]
+        else:
+            yield arg
+
+
+def config_args(config):
+    """black args equivalent to a [tool.black] table"""
+    args = []
+    for key, value in sorted(config.items()):
+        option = "--" + key.replace("_", "-")
+        if option[2:] in IGNORED_CONFIG or value is False:
+            continue
+        if value is True:
+            args.append(option)
+        elif isinstance(value, list):
+            for item in value:
+                args.extend([option, str(item)])
+        else:
+            args.extend([option, str(value)])
+    return args
+
+
+def parse_args(args, defaults=None):
+    """Turn black command line args (as built by sublack) to options.
+
+    defaults: options overridden by args, like the config of pyproject.toml.
+    Raises UnsupportedOption for an unknown option."""
+    options = {
+        "line_length": None,
+        "fast": False,
+        "string_normalization": True,
+        "magic_trailing_comma": True,
+        "preview": False,
+        "is_pyi": False,
+        "py36": False,
+        "target_versions": [],
+        "lines": [],
+    }
+    options.update(defaults or {})
+    targets = []
+    args = split_args(args)
+    try:
+        for arg in args:
+            if arg in ("-l", "--line-length"):
+                options["line_length"] = int(next(args))
+            elif arg == "--fast":
+                options["fast"] = True
+            elif arg == "--safe":
+                options["fast"] = False
+            elif arg in ("-S", "--skip-string-normalization"):
+                options["string_normalization"] = False
+            elif arg in ("-C", "--skip-magic-trailing-comma"):
+                options["magic_trailing_comma"] = False
+            elif arg == "--preview":
+                options["preview"] = True
+            elif arg == "--pyi":
+                options["is_pyi"] = True
+            elif arg == "--py36":
+                options["py36"] = True
+            elif arg in ("-t", "--target-version"):
+                targets.append(next(args))
+            elif arg == "--line-ranges":
+                start, _, end = next(args).partition("-")
+                options["lines"].append((int(start), int(end)))
+            elif arg == "-" or arg in QUIET_OPTIONS:
+                continue
+            else:
+                raise UnsupportedOption("unsupported option {}".format(arg))
+    except (StopIteration, ValueError):
+        raise UnsupportedOption("invalid value for {}".format(arg))
+    if targets:
+        # like black, command line targets replace the config ones
+        options["target_versions"] = targets
+    return options
+
+
+def get_mode(black, options):
+    versions = set(black.TargetVersion[v.upper()] for v in options["target_versions"])
+    if options["py36"]:
+        versions |= set(
+            v for v in black.TargetVersion if v.value >= black.TargetVersion.PY36.value
+        )
+
+    kwargs = {
+        "target_versions": versions,
+        "line_length": options["line_length"] or black.DEFAULT_LINE_LENGTH,
+        "is_pyi": options["is_pyi"],
+        "string_normalization": options["string_normalization"],
+    }
+    # only passed if needed: older black's Mode doesn't know them
+    if not options["magic_trailing_comma"]:
+        kwargs["magic_trailing_comma"] = False
+    if options["preview"]:
+        kwargs["preview"] = True
+
+    mode_class = getattr(black, "Mode", None) or black.FileMode
+    try:
+        return mode_class(**kwargs)
+    except TypeError as err:
+        raise UnsupportedOption(str(err))
+
+
+def decode_bytes(content):
+    """Return (source, encoding, newline) like black does for stdin."""
+    srcbuf = io.BytesIO(content)
+    encoding, lines = tokenize.detect_encoding(srcbuf.readline)
+    if not lines:
+        return "", encoding, "\n"
+
+    newline = "\r\n" if lines[0][-2:] == b"\r\n" else "\n"
+    srcbuf.seek(0)
+    with io.TextIOWrapper(srcbuf, encoding) as tiow:
+        return tiow.read(), encoding, newline
+
+
+def format_with_black(black, args, content, config=None):
+    """Format content like `black args -` does, config being the [tool.black]
+    table black would read.
+
+    Returns the Popen format: returncode(int), out(byte), err(byte).
+    Raises UnsupportedOption if black's command line must be used instead."""
+    options = parse_args(args, parse_args(config_args(config or {})))
+    try:
+        mode = get_mode(black, options)
+        src, encoding, newline = decode_bytes(content)
+        kwargs = {"fast": options["fast"], "mode": mode}
+        if options["lines"]:
+            kwargs["lines"] = options["lines"]
+        try:
+            dst = black.format_file_contents(src, **kwargs)
+        except black.NothingChanged:
+            return 0, content, UNCHANGED.encode()
+        if newline != "\n":
+            dst = dst.replace("\n", newline)
+        return 0, dst.encode(encoding), REFORMATTED.encode()
+    except UnsupportedOption:
+        raise
+    except Exception as err:
+        return 123, b"", "error: cannot format -: {}".format(err).encode()
+
+
+# fields of ast nodes holding statements, in source order
+BODIES = ("body", "handlers", "orelse", "finalbody", "cases")
+
+
+def statement_lines(tree):
+    """1-based line number of each statement and except clause of tree, the
+    nodes which can be folded. Expressions are not walked."""
+    lines = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        lineno = getattr(node, "lineno", None)
+        if lineno is None and hasattr(node, "pattern"):
+            # match_case has no position, its pattern has
+            lineno = node.pattern.lineno
+        if lineno is not None:
+            lines.append(lineno)
+        for field in reversed(BODIES):
+            children = getattr(node, field, None)
+            if isinstance(children, list):
+                stack.extend(reversed(children))
+    return lines
+
+
+def ast_index(content, encoding):
+    """statement_lines of content"""
+    return statement_lines(ast.parse(content.decode(encoding)))
+
+
+def serve(black, stdin, stdout):
+    while True:
+        try:
+            header, body = read_message(stdin)
+        except EOFError:
+            return
+
+        action = header.get("action")
+        if action == "format" and black:
+            try:
+                returncode, out, err = format_with_black(
+                    black, header["args"], body, header.get("config")
+                )
+            except UnsupportedOption as err:
+                write_message(
+                    stdout, {"returncode": -1, "err": str(err), "unsupported": True}
+                )
+            else:
+                write_message(
+                    stdout, {"returncode": returncode, "err": err.decode()}, out
+                )
+        elif action == "index":
+            try:
+                index = ast_index(body, header.get("encoding", "utf-8"))
+            except (SyntaxError, ValueError) as err:
+                write_message(stdout, {"returncode": 1, "err": str(err)})
+            else:
+                write_message(
+                    stdout, {"returncode": 0, "err": ""}, json.dumps(index).encode()
+                )
+        elif action == "ping":
+            version = black.__version__ if black else ""
+            write_message(stdout, {"returncode": 0, "err": version})
+        else:
+            write_message(
+                stdout, {"returncode": -1, "err": "unknown action {}".format(action)}
+            )
+
+
+def main():
+    if "--index" in sys.argv:
+        black = None
+    else:
+        try:
+            import black
+        except ImportError as err:
+            sys.stderr.write("sublack worker: {}\n".format(err))
+            sys.exit(1)
+
+    # keep stdout for the protocol only
+    stdout = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    serve(black, sys.stdin.buffer, stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,7 @@ class TestBlackMethod(TestCase):
         gcl = sublack.blacker.Black.get_command_line
         v = MagicMock()
         s = MagicMock()
+        s.pre_commit_black = None
         s.config = {
             "black_command": "black",
             "black_line_length": None,
@@ -119,6 +120,100 @@ class TestBlackMethod(TestCase):
                     "You may need to install Black and/or configure 'black_command' in Sublack's Settings.",
                 )
 
+    def test_format_pre_commit_black_not_in_worker(self):
+        s = MagicMock()
+        s.get_cached.return_value = None
+        s.config = {
+            "black_mode": None,
+            "black_use_blackd": False,
+            "black_use_worker": True,
+        }
+        s.pre_commit_black = sublack.precommit.PreCommitBlack(
+            "/cache/black", ["--line-length=100"]
+        )
+        job = MagicMock(blocks=None, extra=[], cmd=["/cache/black", "-"])
+        with patch.object(sublack.blacker.BlackWorker, "get") as get:
+            sublack.blacker.Black.format(s, job)
+        get.assert_not_called()
+        s.run_black.assert_called_once_with(
+            job.cmd, job.env, job.cwd, job.content, job=job
+        )
+
+    def test_run_formatter_inprocess(self):
+        config = {"black_mode": "inprocess", "black_sys_path": []}
+        pyproject = {"preview": True}
+        run_black = MagicMock()
+        black = MagicMock(__version__="19.3b0")
+
+        def ri(cmd, content):
+            return sublack.blacker.run_formatter(
+                cmd, content, "utf-8", config, pyproject, run_black
+            )
+
+        # importable, same version
+        with patch.object(sublack.blacker, "import_black", return_value=black):
+            with patch.object(
+                sublack.blacker,
+                "get_black_version",
+                return_value=("black", "black, version 19.3b0"),
+            ):
+                with patch.object(
+                    sublack.blacker, "format_with_black", return_value=(0, b"", b"")
+                ) as fwb:
+                    ri(["black", "-", "--fast"], b"a=1")
+                    fwb.assert_called_with(black, ["-", "--fast"], b"a=1", pyproject)
+                    run_black.assert_not_called()
+
+                # option black's api can't apply
+                with patch.object(
+                    sublack.blacker,
+                    "format_with_black",
+                    side_effect=sublack.worker.UnsupportedOption("--diff"),
+                ):
+                    ri(["black", "-", "--diff"], b"a=1")
+                    run_black.assert_called_with(["black", "-", "--diff"], b"a=1")
+
+        # wrong version
+        with patch.object(sublack.blacker, "import_black", return_value=black):
+            with patch.object(
+                sublack.blacker,
+                "get_black_version",
+                return_value=("black", "black, version 19.10b0"),
+            ):
+                ri(["black", "-"], b"a=1")
+                run_black.assert_called_with(["black", "-"], b"a=1")
+
+        # same prefix is not the same version
+        black.__version__ = "19.3"
+        with patch.object(sublack.blacker, "import_black", return_value=black):
+            with patch.object(
+                sublack.blacker,
+                "get_black_version",
+                return_value=("black", "black, version 19.3b0"),
+            ):
+                with patch.object(sublack.blacker, "format_with_black") as fwb:
+                    ri(["black", "-"], b"a=2")
+                    fwb.assert_not_called()
+                    run_black.assert_called_with(["black", "-"], b"a=2")
+
+        # not importable
+        run_black.reset_mock()
+        with patch.object(sublack.blacker, "import_black", return_value=None):
+            ri(["black", "-"], b"a=1")
+            run_black.assert_called_with(["black", "-"], b"a=1")
+
+    def test_run_formatter_worker_fallback(self):
+        config = {"black_mode": None, "black_use_blackd": False}
+        config["black_use_worker"] = True
+        run_black = MagicMock()
+        worker = MagicMock(side_effect=sublack.server.BlackWorkerError("failed"))
+        with patch.object(sublack.blacker.BlackWorker, "get", return_value=worker):
+            sublack.blacker.run_formatter(
+                ["black", "-"], b"a=1", "utf-8", config, {"preview": True}, run_black
+            )
+        worker.assert_called_once_with(["-"], b"a=1", {"preview": True})
+        run_black.assert_called_once_with(["black", "-"], b"a=1")
+
     def test_good_working_dir(self):
         gg = sublack.blacker.Black.get_good_working_dir
 
@@ -148,66 +243,176 @@ class TestCache(TestCase):
     def setUp(self):
         # data
         self.view = view()
-        self.ah = str(hash("a"))
-        self.bh = str(hash("b"))
-        self.cmd1 = ["cmd1"]
-        self.cache = (
-            self.ah + "|||" + str(self.cmd1) + "\n" + self.bh + "|||" + str(self.cmd1)
-        )
+        self.cmd1 = ["black", "-"]
         # view
         self.black = sublack.blacker.Black(self.view)
 
         # temp file
         temp = tempfile.NamedTemporaryFile(delete=True)
         temp.close()
-        self.black.formatted_cache = pathlib.Path(temp.name)
-        with self.black.formatted_cache.open(mode="w") as f:
-            f.write(self.cache)
+        self.black.formatted_cache = sublack.cache.FormatCache(pathlib.Path(temp.name))
+        self.ah = self.black.cache_key(b"a", self.cmd1)
+        self.bh = self.black.cache_key(b"b", self.cmd1)
+        # append-only log: most recent last
+        with self.black.formatted_cache.path.open(mode="w") as f:
+            f.write(self.ah + " =\n" + self.bh + " =\n")
 
     def tearDown(self):
-        self.black.formatted_cache.unlink()
+        self.black.formatted_cache.path.unlink()
         self.view.set_scratch(True)
         self.view.window().run_command("close_file")
 
     def test_is_cached(self):
 
         # test first line present
-        self.assertTrue(self.black.is_cached("a", self.cmd1))
+        self.assertTrue(self.black.is_cached(b"a", self.cmd1))
 
         # test second line present
-        self.assertTrue(self.black.is_cached("b", self.cmd1))
+        self.assertTrue(self.black.is_cached(b"b", self.cmd1))
 
         # test content ok cmd not ok
-        self.assertFalse(self.black.is_cached("b", ["cmd2"]))
+        self.assertFalse(self.black.is_cached(b"b", ["black", "-", "--fast"]))
 
         # test contnent not cmd ok
-        self.assertFalse(self.black.is_cached("c", self.cmd1))
+        self.assertFalse(self.black.is_cached(b"c", self.cmd1))
+
+    def test_is_cached_no_file_read(self):
+        self.assertTrue(self.black.is_cached(b"a", self.cmd1))
+        self.black.formatted_cache.path.unlink()
+        self.assertTrue(self.black.is_cached(b"b", self.cmd1))
+        self.black.formatted_cache.path.touch()
 
     def test_add_to_cache(self):
 
-        # test already in , not added
-        self.assertFalse(self.black.add_to_cache("a", self.cmd1))
+        # test already most recent, not added
+        self.assertFalse(self.black.add_to_cache(b"b", self.cmd1))
 
-        # test added and contenu
-        self.assertTrue(self.black.add_to_cache("c", self.cmd1))
+        # test added and contenu, appended to the file
+        self.assertTrue(self.black.add_to_cache(b"c", self.cmd1))
+        self.black.formatted_cache.flush()
+        ch = self.black.cache_key(b"c", self.cmd1)
         self.assertEqual(
-            self.black.formatted_cache.open().read(),
-            "{}|||['cmd1']\n{}|||['cmd1']\n{}|||['cmd1']".format(
-                str(hash("c")), self.ah, self.bh
-            ),
+            self.black.formatted_cache.path.open().read(),
+            "{} =\n{} =\n{} =\n".format(self.ah, self.bh, ch),
         )
+        self.assertEqual(self.black.formatted_cache.read(), [ch, self.bh, self.ah])
+
+    def test_add_to_cache_refresh_lru(self):
+        self.assertTrue(self.black.add_to_cache(b"a", self.cmd1))
+        self.assertEqual(self.black.formatted_cache.read(), [self.ah, self.bh])
 
     def test_limite_cache_size(self):
-        ligne = self.ah + "|||" + str(self.cmd1) + "\n"
-        with self.black.formatted_cache.open("wt") as f:
-            f.write(251 * ligne)
+        self.black.formatted_cache.size = 3
+        self.black.add_to_cache(b"c", self.cmd1)
+        self.black.add_to_cache(b"d", self.cmd1)
+
+        cached = self.black.formatted_cache.read()
+        self.assertEqual(len(cached), 3)
+        self.assertEqual(cached[1:], [self.black.cache_key(b"c", self.cmd1), self.bh])
+
+    def test_reload_from_disk(self):
+        self.black.add_to_cache(b"a", self.cmd1)
+        self.black.formatted_cache.flush()
+        reloaded = sublack.cache.FormatCache(self.black.formatted_cache.path)
+        self.assertEqual(reloaded.read(), [self.ah, self.bh])
+
+    def test_compaction(self):
+        cache = self.black.formatted_cache
+        cache.size = 2
+        for c in [b"c", b"d", b"a"]:
+            self.black.add_to_cache(c, self.cmd1)
+            cache.flush()
+        self.assertEqual(
+            cache.path.open().read().splitlines(),
+            [self.black.cache_key(b"d", self.cmd1) + " =", self.ah + " ="],
+        )
+
+    def test_get_cached(self):
+        self.assertEqual(self.black.get_cached(b"a", self.cmd1), b"a")
+        self.assertIsNone(self.black.get_cached(b"c", self.cmd1))
+
+        self.black.add_to_cache(b"c", self.cmd1, b"formatted c")
+        self.assertEqual(self.black.get_cached(b"c", self.cmd1), b"formatted c")
+
+    def test_lookup(self):
+        cache = self.black.formatted_cache
+        self.assertIsNone(cache.lookup(self.ah))
+        self.assertIs(cache.lookup("missing"), cache.MISSING)
+        with self.assertRaises(KeyError):
+            cache.get("missing")
+
+    def test_output_persisted(self):
+        self.black.add_to_cache(b"c", self.cmd1, b"formatted c")
+        self.black.get_cached(b"a", self.cmd1)  # refresh a
+        self.black.formatted_cache.flush()
+
+        reloaded = sublack.cache.FormatCache(self.black.formatted_cache.path)
+        self.assertEqual(
+            reloaded.read(), [self.ah, self.black.cache_key(b"c", self.cmd1), self.bh]
+        )
+        self.assertEqual(
+            reloaded.get(self.black.cache_key(b"c", self.cmd1)), b"formatted c"
+        )
+
+    def test_limit_cache_bytes(self):
+        cache = self.black.formatted_cache
+        big = os.urandom(2000)  # not compressible
+        compressed = len(sublack.cache.compress(big))
+        # room for b, c and d but not a
+        cache.max_bytes = 3 * cache.ENTRY_OVERHEAD + 2 * compressed
+        self.black.add_to_cache(b"c", self.cmd1, big)
+        self.assertEqual(len(cache.read()), 3)
+        self.black.add_to_cache(b"d", self.cmd1, big)
+        self.assertEqual(
+            cache.read(),
+            [
+                self.black.cache_key(b"d", self.cmd1),
+                self.black.cache_key(b"c", self.cmd1),
+                self.bh,
+            ],
+        )
+
+
+class TestCacheKey(TestCase):
+    version = ("/usr/bin/black", "black, version 19.3b0")
+
+    def test_normalize_options(self):
+        no = sublack.cache.normalize_options
+        self.assertEqual(
+            no(["black", "-", "--fast", "-l", "90", "--diff"]),
+            [("-l", "90"), ("--fast", "")],
+        )
+        self.assertEqual(
+            no("black - --target-version py37 --target-version py36".split()),
+            no("black - --target-version py36 --target-version py37".split()),
+        )
 
-        self.black.add_to_cache("b", self.cmd1)
+    def test_digest_is_stable(self):
+        d = sublack.cache.digest
+        cmd = ["black", "-", "-l", "90", "--fast"]
+        self.assertEqual(
+            d(b"a", cmd, self.version),
+            d(b"a", ["black", "-", "--fast", "-l", "90"], self.version),
+        )
+        self.assertEqual(d("a", cmd, self.version), d(b"a", cmd, self.version))
+        self.assertNotEqual(d(b"a", cmd, self.version), d(b"b", cmd, self.version))
+        self.assertNotEqual(
+            d(b"a", cmd, self.version),
+            d(b"a", cmd, ("/usr/bin/black", "black, version 19.10b0")),
+        )
 
-        new_line = "{}|||['cmd1']".format(self.bh)
-        cached = self.black.formatted_cache.open().read().splitlines()
-        self.assertEqual(len(cached), 251)
-        self.assertEqual(cached[:2], [new_line] + [ligne.strip()])
+    def test_digest_pyproject(self):
+        d = sublack.cache.digest
+        cmd = ["black", "-"]
+        self.assertEqual(d(b"a", cmd, self.version), d(b"a", cmd, self.version, {}))
+        self.assertNotEqual(
+            d(b"a", cmd, self.version),
+            d(b"a", cmd, self.version, {"skip-magic-trailing-comma": True}),
+        )
+        self.assertEqual(
+            d(b"a", cmd, self.version, {"preview": True, "line-length": 9}),
+            d(b"a", cmd, self.version, {"line-length": 9, "preview": True}),
+        )
 
 
 class TestBlackdClass(TestCase):
@@ -216,7 +421,7 @@ class TestBlackdClass(TestCase):
 
         # dep
         cmd = "black - -l 25 --fast --skip-string-normalization --py36 --target-version py37".split()
-        h = sublack.blacker.Blackd.format_headers("self", cmd)
+        h = sublack.blacker.Blackd.format_headers(cmd)
         h["X-Python-Variant"] = set(h["X-Python-Variant"].split(","))
         self.assertEqual(
             h,
@@ -230,7 +435,7 @@ class TestBlackdClass(TestCase):
 
         # standard
         cmd = "black - -l 25 --fast --skip-string-normalization --py36".split()
-        h = sublack.blacker.Blackd.format_headers("self", cmd)
+        h = sublack.blacker.Blackd.format_headers(cmd)
         self.assertEqual(
             h,
             {
@@ -243,7 +448,7 @@ class TestBlackdClass(TestCase):
 
         # target-version
         cmd = "black - -l 25 --fast --skip-string-normalization --target-version py36 --target-version py37".split()
-        h = sublack.blacker.Blackd.format_headers("self", cmd)
+        h = sublack.blacker.Blackd.format_headers(cmd)
         h["X-Python-Variant"] = set(h["X-Python-Variant"].split(","))
         self.assertEqual(
             h,
@@ -254,3 +459,127 @@ class TestBlackdClass(TestCase):
                 "X-Fast-Or-Safe": "fast",
             },
         )
+
+    def test_headers_template(self):
+        cmd = "black - -l 25 --fast".split()
+        h = sublack.blacker.Blackd.get_headers(cmd, "utf-8")
+        self.assertEqual(
+            h,
+            {
+                "X-Line-Length": "25",
+                "X-Fast-Or-Safe": "fast",
+                "Content-Type": "application/octet-stream; charset=utf-8",
+            },
+        )
+        self.assertIs(h, sublack.blacker.Blackd.get_headers(list(cmd), "utf-8"))
+        self.assertIsNot(h, sublack.blacker.Blackd.get_headers(cmd, "latin-1"))
+
+
+class TestBlackdSession(TestCase):
+    config = {"black_blackd_host": "localhost", "black_blackd_port": "1"}
+
+    def tearDown(self):
+        sublack.blacker.Blackd.close_session("http://localhost:1/")
+
+    def test_session_reused(self):
+        b1 = sublack.blacker.Blackd(["black", "-"], b"", "utf-8", self.config)
+        b2 = sublack.blacker.Blackd(["black", "-"], b"", "utf-8", self.config)
+        self.assertIs(b1.get_session(b1.url), b2.get_session(b2.url))
+
+    def test_reconnect(self):
+        b = sublack.blacker.Blackd(["black", "-"], b"a=1", "utf-8", self.config)
+        dropped = MagicMock()
+        dropped.post.side_effect = sublack.blacker.requests.ConnectionError
+        sublack.blacker.Blackd.sessions[b.url] = dropped
+        fresh = MagicMock()
+        with patch.object(sublack.blacker.requests, "Session", return_value=fresh):
+            self.assertEqual(b.post(), fresh.post.return_value)
+        dropped.close.assert_called_once_with()
+        self.assertIs(sublack.blacker.Blackd.sessions[b.url], fresh)
+
+
+class TestFormatScheduler(TestCase):
+    def setUp(self):
+        self.scheduler = sublack.blacker.FormatScheduler()
+        self.async_calls = []
+        self.black = MagicMock()
+        self.black.format.side_effect = lambda job: (0, job.content, b"")
+        self.view = MagicMock()
+        self.view.id.return_value = 1
+        self.view.change_count.return_value = 1
+
+    def job(self, content, change_count=1):
+        self.view.change_count.return_value = change_count
+        return sublack.blacker.FormatJob(
+            self.view, content, "utf-8", ["black", "-"], None, {}, []
+        )
+
+    def run_async(self):
+        while self.async_calls:
+            self.async_calls.pop(0)()
+
+    def submit(self, job):
+        with patch.object(sublack.blacker.sublime, "set_timeout_async") as sta:
+            sta.side_effect = lambda f, *a: self.async_calls.append(f)
+            self.scheduler.submit(self.black, job)
+
+    def test_latest_wins(self):
+        first, second, third = self.job(b"1", 1), self.job(b"2", 2), self.job(b"3", 3)
+        self.submit(first)
+        self.submit(second)
+        self.submit(third)
+        self.assertTrue(first.cancelled)
+        self.assertEqual(self.scheduler.queued[1], (self.black, third))
+        with patch.object(sublack.blacker.sublime, "set_timeout_async") as sta:
+            sta.side_effect = lambda f, *a: self.async_calls.append(f)
+            with patch.object(sublack.blacker.sublime, "set_timeout"):
+                self.run_async()
+
+        # first cancelled before running, second never run
+        self.black.format.assert_called_once_with(third)
+        self.assertEqual(sublack.blacker.FormatJob.done.pop(1), (self.black, third))
+        self.assertEqual(self.scheduler.running, {})
+
+    def test_same_request_not_run_twice(self):
+        first, second = self.job(b"1"), self.job(b"1")
+        self.submit(first)
+        self.submit(second)
+        self.assertFalse(first.cancelled)
+        self.assertEqual(self.scheduler.queued, {})
+
+    def test_cancel_kills_process(self):
+        job = self.job(b"1")
+        proc = MagicMock()
+        proc.poll.return_value = None
+        job.attach(proc)
+        self.scheduler.running[1] = (self.black, job)
+        self.scheduler.cancel(1)
+        proc.kill.assert_called_once_with()
+
+        # process attached after cancel
+        late = MagicMock()
+        late.poll.return_value = None
+        job.attach(late)
+        late.kill.assert_called_once_with()
+
+    def test_format_error_releases_view(self):
+        self.black.format.side_effect = OSError("black not found")
+        job = self.job(b"1")
+        self.submit(job)
+        with patch.object(sublack.blacker.sublime, "set_timeout") as st:
+            st.side_effect = lambda f, *a: f()
+            self.run_async()
+        self.assertEqual(self.scheduler.running, {})
+        self.view.set_status.assert_called_once_with(
+            sublack.consts.STATUS_KEY,
+            sublack.consts.FORMAT_FAILED_MESSAGE.format("black not found"),
+        )
+
+        # next format runs
+        self.black.format.side_effect = lambda job: (0, job.content, b"")
+        second = self.job(b"2", 2)
+        self.submit(second)
+        self.assertEqual(len(self.async_calls), 1)
+        with patch.object(sublack.blacker.sublime, "set_timeout"):
+            self.run_async()
+        self.assertEqual(sublack.blacker.FormatJob.done.pop(1), (self.black, second))
@@ -1,5 +1,7 @@
+import os
+import tempfile
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import sublime
 from fixtures import (
@@ -30,6 +32,11 @@ TEST_BLACK_SETTINGS = {
     "black_blackd_host": "localhost",
     "black_blackd_port": "",
     "black_use_precommit": False,
+    "black_use_worker": False,
+    "black_mode": None,
+    "black_sys_path": [],
+    "black_async": False,
+    "black_on_save_modified_only": False,
 }
 
 
@@ -67,6 +74,22 @@ class TestBlack(TestCaseBlack):
             sublack.consts.ALREADY_FORMATTED_MESSAGE_CACHE,
         )
 
+    def test_black_file_reformatted_cached(self, s, c):
+        # clear cache
+        sublack.utils.clear_cache()
+
+        self.setText(unblacked)
+        self.view.run_command("black_file")
+        self.view.run_command("undo")
+        self.assertEqual(unblacked, self.all())
+
+        self.view.run_command("black_file")
+        self.assertEqual(blacked, self.all())
+        self.assertEqual(
+            self.view.get_status(sublack.consts.STATUS_KEY),
+            sublack.consts.REFORMATTED_MESSAGE_CACHE,
+        )
+
     def test_black_file_dirty_stay_dirty(self, s, c):
         self.setText(blacked)
         self.assertTrue(self.view.is_dirty())
@@ -94,6 +117,47 @@ class TestBlack(TestCaseBlack):
         v.set_scratch(True)
         v.close()
 
+    def test_selections_kept(self, s, c):
+        self.setText("a = 1\nb=2\nc = 3\n")
+        sel = self.view.sel()
+        sel.clear()
+        sel.add_all([sublime.Region(1, 2), sublime.Region(14, 16)])
+        self.view.run_command("black_file")
+        self.assertEqual(self.all(), "a = 1\nb = 2\nc = 3\n")
+        self.assertEqual(list(sel), [sublime.Region(1, 2), sublime.Region(16, 18)])
+
+    def test_folds_outside_changes_kept(self, s, c):
+        self.setText("def a():\n    pass\n\n\ndef b():\n    x=1\n")
+        self.view.fold(sublime.Region(8, 17))
+        self.view.run_command("black_file")
+        self.assertEqual(
+            self.all(), "def a():\n    pass\n\n\ndef b():\n    x = 1\n"
+        )
+        self.assertEqual(
+            self.view.unfold(sublime.Region(0, self.view.size())),
+            [sublime.Region(8, 17)],
+        )
+
+    def test_format_selection(self, s, c):
+        self.setText("a=1\ndef f( ):\n  pass\nb=2\n")
+        sel = self.view.sel()
+        sel.clear()
+        sel.add(sublime.Region(12, 12))
+        self.view.run_command("black_format_selection")
+        self.assertEqual(self.all(), "a=1\ndef f():\n    pass\n\n\nb=2\n")
+
+    def test_format_selection_nothing(self, s, c):
+        self.setText("a=1\n")
+        sel = self.view.sel()
+        sel.clear()
+        sel.add(sublime.Region(4, 4))
+        self.view.run_command("black_format_selection")
+        self.assertEqual(self.all(), "a=1\n")
+        self.assertEqual(
+            self.view.get_status(sublack.consts.STATUS_KEY),
+            sublack.consts.NOTHING_TO_FORMAT_MESSAGE,
+        )
+
     def test_folding1(self, s, c):
         self.setText(
             """class A:
@@ -145,6 +209,78 @@ class A:
         )
 
 
+WORKER_BLACK_SETTINGS = dict(TEST_BLACK_SETTINGS, black_use_worker=True)
+
+
+@patch.object(sublack.commands, "is_python", return_value=True)
+@patch.object(sublack.blacker, "get_settings", return_value=WORKER_BLACK_SETTINGS)
+class TestBlackWorker(TestCaseBlack):
+    def setUp(self):
+        super().setUp()
+        sublack.utils.clear_cache()
+
+    def test_black_file(self, s, c):
+        self.setText(unblacked)
+        self.view.run_command("black_file")
+        self.assertEqual(blacked, self.all())
+        self.assertTrue(sublack.BlackWorker.get("black").is_running())
+
+    def test_black_file_nothing_todo(self, s, c):
+        self.setText(blacked)
+        self.view.run_command("black_file")
+        self.assertEqual(blacked, self.all())
+        self.assertEqual(
+            self.view.get_status(sublack.consts.STATUS_KEY),
+            sublack.consts.ALREADY_FORMATTED_MESSAGE,
+        )
+
+
+ASYNC_BLACK_SETTINGS = dict(TEST_BLACK_SETTINGS, black_async=True)
+
+
+class TestBlackAsync(TestCaseBlackAsync):
+    def setUp(self):
+        super().setUp()
+        # patch decorators don't work with generators tests
+        self.patchers = [
+            patch.object(sublack.commands, "is_python", return_value=True),
+            patch.object(
+                sublack.blacker, "get_settings", return_value=ASYNC_BLACK_SETTINGS
+            ),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        sublack.utils.clear_cache()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        super().tearDown()
+
+    def test_black_file(self):
+        self.setText(unblacked)
+        self.view.run_command("black_file")
+        yield lambda: self.all() == blacked
+        self.assertEqual(
+            self.view.get_status(sublack.consts.STATUS_KEY),
+            sublack.consts.REFORMATTED_MESSAGE,
+        )
+
+    def test_black_file_view_changed(self):
+        self.setText(unblacked)
+        self.view.run_command("black_file")
+        self.setText("\n")
+        yield lambda: self.view.get_status(
+            sublack.consts.STATUS_KEY
+        ) == sublack.consts.DISCARDED_MESSAGE
+        self.assertEqual(unblacked + "\n", self.all())
+
+    def test_black_file_sync(self):
+        self.setText(unblacked)
+        self.view.run_command("black_file", {"sync": True})
+        self.assertEqual(blacked, self.all())
+
+
 class TestBlackdServer(TestCase):
     def setUp(self):
         self.port = str(sublack.get_open_port())
@@ -242,7 +378,7 @@ class TestBlackdServer(TestCase):
     # )
 
 
-class TestFormatAll(TestCaseBlack):
+class TestFormatAll(TestCaseBlackAsync):
     def setUp(self):
         super().setUp()
         self.window.set_project_data({"folders": [{"path": str(self.folder)}]})
@@ -252,6 +388,9 @@ class TestFormatAll(TestCaseBlack):
         if hasattr(self, "wrong"):
             self.wrong.unlink()
 
+    def finished(self):
+        return self.window.id() not in sublack.BlackFormatAllCommand.running
+
     def test_black_all_success(self):
 
         # make sure we have a window to work with
@@ -261,6 +400,7 @@ class TestFormatAll(TestCaseBlack):
 
         with patch("sublime.ok_cancel_dialog", return_value=True):
             self.window.run_command("black_format_all")
+        yield self.finished
         self.assertEqual(
             self.window.active_view().get_status(sublack.STATUS_KEY),
             sublack.REFORMATTED_MESSAGE,
@@ -275,11 +415,78 @@ class TestFormatAll(TestCaseBlack):
 
         with patch("sublime.ok_cancel_dialog", return_value=True):
             self.window.run_command("black_format_all")
+        yield self.finished
         self.assertEqual(
             self.window.active_view().get_status(sublack.STATUS_KEY),
             sublack.REFORMAT_ERRORS,
             "reformat should be error",
         )
+        panel = self.window.find_output_panel(sublack.FORMAT_ALL_PANEL)
+        self.assertIn(
+            "error: {}".format(self.wrong),
+            panel.substr(sublime.Region(0, panel.size())),
+        )
+
+
+class TestBlackOnSaveListener(TestCase):
+    def setUp(self):
+        self.view = MagicMock()
+        self.listener = sublack.BlackOnSaveListener(self.view)
+        patcher = patch.object(sublack.commands, "find_pyproject", return_value=None)
+        self.find_pyproject = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_is_applicable(self):
+        is_applicable = sublack.BlackOnSaveListener.is_applicable
+        self.assertTrue(
+            is_applicable({"syntax": "Packages/Python/Python.sublime-syntax"})
+        )
+        self.assertFalse(
+            is_applicable({"syntax": "Packages/Markdown/Markdown.sublime-syntax"})
+        )
+
+    def test_decided_once(self):
+        with patch.object(
+            sublack.commands, "get_on_save_fast", return_value=True
+        ) as on_save:
+            self.listener.on_activated_async()
+            self.listener.on_pre_save()
+            self.listener.on_pre_save()
+        on_save.assert_called_once_with(self.view)
+        self.view.run_command.assert_called_with(
+            "black_file", {"sync": True, "on_save": True}
+        )
+        self.assertEqual(self.view.run_command.call_count, 2)
+
+    def test_decided_again(self):
+        with patch.object(
+            sublack.commands, "get_on_save_fast", return_value=False
+        ) as on_save:
+            self.listener.on_pre_save()
+            # view settings changed
+            self.listener.invalidate()
+            self.listener.on_pre_save()
+            # root file saved
+            sublack.BlackOnSaveListener.generation += 1
+            self.listener.on_pre_save()
+        self.assertEqual(on_save.call_count, 3)
+        self.view.run_command.assert_not_called()
+
+    def test_decided_again_pyproject_modified(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pyproject = Path(tmp) / "pyproject.toml"
+            pyproject.write_text("[tool.black]\n")
+            os.utime(str(pyproject), (1, 1))
+            self.find_pyproject.return_value = pyproject
+            with patch.object(
+                sublack.commands, "get_on_save_fast", return_value=False
+            ) as on_save:
+                self.listener.on_pre_save()
+                self.listener.on_pre_save()
+                # modified outside sublime
+                pyproject.write_text('[tool.black]\nforce-exclude = "a"\n')
+                self.listener.on_pre_save()
+        self.assertEqual(on_save.call_count, 2)
 
 
 PRECOMMIT_BLACK_SETTINGS = {
@@ -297,6 +504,11 @@ PRECOMMIT_BLACK_SETTINGS = {
     "black_blackd_host": "localhost",
     "black_blackd_port": "",
     "black_use_precommit": True,
+    "black_use_worker": False,
+    "black_mode": None,
+    "black_sys_path": [],
+    "black_async": False,
+    "black_on_save_modified_only": False,
 }
 
 precommit_config_path = Path(Path(__file__).parent, ".pre-commit-config.yaml")
@@ -0,0 +1,82 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from fixtures import sublack, blacked
+import sublime
+
+LineDiff = sublack.diffing.LineDiff
+ViewState = sublack.diffing.ViewState
+
+OLD = "a\n\n\nb=1\nc\n"
+NEW = "a\nb = 1\nc\nd\n"
+
+
+class TestLineDiff(TestCase):
+    def test_hunks(self):
+        diff = LineDiff(OLD, NEW)
+        self.assertEqual(
+            diff.hunks(),
+            [(sublime.Region(10, 10), "d\n"), (sublime.Region(2, 8), "b = 1\n")],
+        )
+
+    def test_map_line(self):
+        diff = LineDiff(OLD, NEW)
+        self.assertEqual(
+            [diff.map_line(i) for i in range(5)], [0, None, None, None, 2]
+        )
+
+    def test_touches(self):
+        diff = LineDiff(OLD, NEW)
+        self.assertFalse(diff.touches(0, 0))
+        self.assertTrue(diff.touches(0, 1))
+        self.assertTrue(diff.touches(3, 4))
+        # insertion after the last line
+        self.assertFalse(diff.touches(4, 4))
+        self.assertTrue(LineDiff("a\nb\nc\n", "a\nb\nx\nc\n").touches(1, 2))
+
+    def test_changed_lines(self):
+        self.assertEqual(LineDiff(OLD, NEW).changed_lines(), [1, 3])
+        # deletion marks the following line
+        self.assertEqual(LineDiff("a\nb\nc\n", "a\nc\n").changed_lines(), [1])
+        self.assertEqual(LineDiff("a\nb\n", "a\n").changed_lines(), [0])
+
+    def test_map_points(self):
+        diff = LineDiff(OLD, NEW)
+        # equal lines, blank line, before "1" and "=" of "b=1", end of text
+        self.assertEqual(diff.map_points([8, 0, 2, 6, 5, 10]), [8, 0, 2, 6, 4, 12])
+        self.assertEqual(diff.map_region(sublime.Region(6, 9)), sublime.Region(6, 9))
+
+    def test_rows(self):
+        diff = LineDiff(OLD, NEW)
+        self.assertEqual(diff.old_row(5), 3)
+        self.assertEqual(diff.new_row(5), 1)
+        self.assertEqual(diff.new_row(12), 3)
+
+    def test_no_change(self):
+        diff = LineDiff(blacked, blacked)
+        self.assertEqual(diff.hunks(), [])
+
+
+class Selection(list):
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(region)
+
+
+class TestViewState(TestCase):
+    def test_restore(self):
+        view = MagicMock()
+        view.sel.return_value = Selection([sublime.Region(5), sublime.Region(6, 8)])
+        view.visible_region.return_value = sublime.Region(8, 10)
+        view.viewport_position.return_value = (0, 30)
+        # anchor "c" is on line 4 before, line 2 after
+        view.text_to_layout.side_effect = [(0, 40), (0, 20)]
+
+        state = ViewState(view)
+        state.restore(LineDiff(OLD, NEW))
+
+        self.assertEqual(view.sel(), [sublime.Region(4), sublime.Region(6, 8)])
+        view.set_viewport_position.assert_called_once_with((0, 10), False)
+        self.assertEqual(state.viewport, (0, 10))
@@ -1,5 +1,7 @@
-from unittest import TestCase
-from unittest.mock import MagicMock
+import itertools
+import sys
+from unittest import TestCase, skipIf
+from unittest.mock import MagicMock, patch
 
 from fixtures import sublack
 import sublime
@@ -12,13 +14,16 @@ SAMPLE = """class A:
             pass
 """
 
-A_EQUAL_INDEX = [1, 1, 1]
+A_EQUAL_INDEX = [1]
 SAMPLE_INDEX = [1, 2, 3, 4]
 
 
 class View:
+    ids = itertools.count(1)
+
     def __init__(self, content):
         self._content = content
+        self._id = next(self.ids)
 
     def unfold(self, region):
         return self._unfold
@@ -54,6 +59,9 @@ class View:
     def sel(self):
         return self._sel
 
+    def id(self):
+        return self._id
+
 
 class Sel:
     def __init__(self, regions=[]):
@@ -82,27 +90,32 @@ class TestFolding(TestCase):
         t = sublack.folding.get_folded_lines(v)
         self.assertEquals(t, [2])
 
-    def test_region_to_refold(self):
-        v = View(SAMPLE)
-        v._sel = Sel()
-
-        def run_command(x, args):
-            v._sel.clear()
-            v._sel.add(sublime.Region(9, 56))
-
-        v.run_command = run_command
-        self.assertEquals(
-            sublime.Region(8, 55), sublack.folding.get_region_to_refold(0, v)
-        )
-
-        def run_command(x, args):
-            v._sel.clear()
-            v._sel.add(sublime.Region(22, 56))
-
-        v.run_command = run_command
-        self.assertEquals(
-            sublime.Region(21, 55), sublack.folding.get_region_to_refold(1, v)
+    def test_get_indented_block(self):
+        lines = [
+            "class A:",
+            "    def a():",
+            "",
+            "        pass",
+            "    x = 1",
+            "",
+            "",
+            "y = 2",
+        ]
+        self.assertEqual(sublack.folding.get_indented_block(lines, 0), (1, 4))
+        self.assertEqual(sublack.folding.get_indented_block(lines, 1), (2, 3))
+        self.assertIsNone(sublack.folding.get_indented_block(lines, 4))
+        self.assertIsNone(sublack.folding.get_indented_block(lines, 7))
+
+    def test_get_refolds(self):
+        v = MagicMock()
+        v.size.return_value = len(SAMPLE)
+        v.substr.return_value = SAMPLE
+        self.assertEqual(
+            sublack.folding.get_refolds(v, [0, 1, 3]),
+            [sublime.Region(8, 55), sublime.Region(21, 55), None],
         )
+        v.run_command.assert_not_called()
+        v.sel.assert_not_called()
 
     def test_get_index_with_python33(self):
         body = b"a=1"
@@ -132,6 +145,14 @@ class TestFolding(TestCase):
         with self.assertRaises(sublack.folding.FoldingError):
             sublack.folding.get_index_with_interpreter(v, b"a=", "utf-8"),
 
+    def test_get_index_with_interpreter_no_new_process(self):
+        v = View(SAMPLE)
+        v.settings = lambda: {"python_interpreter": "python"}
+        sublack.folding.get_index_with_interpreter(v, b"a=1", "utf-8")
+        pid = sublack.IndexWorker.get("python").proc.pid
+        sublack.folding.get_index_with_interpreter(v, SAMPLE.encode(), "utf-8")
+        self.assertEqual(sublack.IndexWorker.get("python").proc.pid, pid)
+
     def test_get_ast_index(self):
         v = View(SAMPLE)
         m = MagicMock()
@@ -150,6 +171,33 @@ class TestFolding(TestCase):
 
         self.assertEquals(sublack.folding.get_ast_index(v, b"a=", "utf-8"), False)
 
+    def test_get_ast_index_cached(self):
+        v = View(SAMPLE)
+        m = MagicMock()
+        m.has.return_value = False
+        v.settings = lambda: m
+        with patch.object(
+            sublack.folding,
+            "get_index_with_python33",
+            wraps=sublack.folding.get_index_with_python33,
+        ) as parse:
+            sublack.folding.get_ast_index(v, b"a=1", "utf-8")
+            sublack.folding.get_ast_index(v, SAMPLE.encode(), "utf-8")
+            self.assertEqual(
+                sublack.folding.get_ast_index(v, b"a=1", "utf-8"), A_EQUAL_INDEX
+            )
+            self.assertEqual(parse.call_count, 2)
+
+            # failures are not cached
+            sublack.folding.get_ast_index(v, b"a=", "utf-8")
+            sublack.folding.get_ast_index(v, b"a=", "utf-8")
+            self.assertEqual(parse.call_count, 4)
+
+            sublack.folding.forget_indexes(v)
+            sublack.folding.get_ast_index(v, b"a=1", "utf-8")
+            self.assertEqual(parse.call_count, 5)
+        sublack.folding.forget_indexes(v)
+
     def test_get_new_lines(self):
         old = [1, 5, 9, 10, 12, 99, 1, 10, 99]
         new = [1, 8, 9, 11, 15, 99, 1, 20, 100]
@@ -160,6 +208,35 @@ class TestFolding(TestCase):
             [0, 7, 10, 98],
         )
 
+    def test_get_index_statements_only(self):
+        body = b"""try:
+    x = [
+        1,
+    ]
+except ValueError:
+    pass
+else:
+    def f():
+        return lambda: (
+            2
+        )
+"""
+        self.assertEqual(
+            sublack.folding.get_index_with_python33(body), [1, 2, 5, 6, 8, 9]
+        )
+
+    @skipIf(sys.version_info < (3, 10), "match needs python 3.10")
+    def test_get_index_match_case(self):
+        body = b"""match x:
+    case [
+        1,
+    ]:
+        pass
+    case _:
+        pass
+"""
+        self.assertEqual(sublack.folding.get_index_with_python33(body), [1, 2, 5, 6, 7])
+
     def test_get_new_lines_line0(self):
         old = [3, 4, 5, 6]
         new = [1, 2, 3, 4]
@@ -0,0 +1,183 @@
+import shutil
+import subprocess
+import tempfile
+from functools import partial
+from unittest import TestCase, skipIf
+from unittest.mock import ANY, MagicMock, patch
+
+from fixtures import sublack
+
+formatall = sublack.formatall
+Path = sublack.utils.Path
+
+
+def run_format_all(root, cls=formatall.FormatAll, cancel=False, **settings):
+    """Run cls on root with black and settings, returns the formatter and its
+    results. cancel: cancelled before run"""
+    window = MagicMock()
+    window.folders.return_value = [str(root)]
+    window.extract_variables.return_value = {}
+    config = {k: None for k in sublack.CONFIG_OPTIONS}
+    config["black_command"] = "black"
+    config.update(settings)
+    with patch.object(formatall, "get_settings", return_value=config):
+        formatter = cls(window, workers=2)
+        if cancel:
+            formatter.cancel()
+        return formatter, formatter.run()
+
+
+class TestFormatAll(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        (self.root / "good.py").write_text("x = 1\n")
+        (self.root / "ugly.py").write_text("x=[ 1 ]\n")
+        (self.root / "wrong.py").write_text("ab ac = 2\n")
+        (self.root / "pyproject.toml").write_text(
+            '[tool.black]\nextend-exclude = "good"\n'
+        )
+        self.formatter, self.results = run_format_all(self.root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_results(self):
+        self.assertEqual(
+            {Path(k).name: v.status for k, v in self.results.items()},
+            {"ugly.py": "reformatted", "wrong.py": "error"},
+        )
+        self.assertEqual((self.root / "ugly.py").read_text(), "x = [1]\n")
+        self.assertEqual(
+            [Path(r.path).name for r in self.formatter.errors()], ["wrong.py"]
+        )
+
+    def test_progress(self):
+        self.assertEqual(
+            (self.formatter.done, self.formatter.total, self.formatter.failed),
+            (2, 2, 1),
+        )
+
+    def test_cancel(self):
+        (self.root / "ugly.py").write_text("x=[ 2 ]\n")
+        formatter, results = run_format_all(self.root, cancel=True)
+        self.assertEqual(formatter.done, 0)
+        self.assertEqual((self.root / "ugly.py").read_text(), "x=[ 2 ]\n")
+
+    def test_manifest_skips_verified_files(self):
+        with patch.object(
+            formatall.FormatAll, "format_content", return_value=(123, b"", b"error")
+        ) as format_content:
+            formatter, results = run_format_all(self.root)
+        # only the file in error is sent to black again
+        format_content.assert_called_once_with(
+            b"ab ac = 2\n",
+            ["black", "-"],
+            ANY,
+            str(self.root),
+            {"extend-exclude": "good"},
+        )
+        self.assertEqual(
+            {Path(k).name: v.status for k, v in results.items()},
+            {"ugly.py": "unchanged", "wrong.py": "error"},
+        )
+
+    def test_manifest_modified_file(self):
+        (self.root / "ugly.py").write_text("x=[ 2 ]\n")
+        formatter, results = run_format_all(self.root)
+        self.assertEqual(results[str(self.root / "ugly.py")].status, "reformatted")
+        self.assertEqual((self.root / "ugly.py").read_text(), "x = [2]\n")
+
+    def test_blackd_unreachable_reported_once(self):
+        (self.root / "other.py").write_text("y=[ 1 ]\n")
+        (self.root / "ugly.py").write_text("x=[ 3 ]\n")
+        with patch.object(formatall.sublime, "set_timeout") as set_timeout:
+            formatter, results = run_format_all(
+                self.root,
+                black_use_blackd=True,
+                black_blackd_host="localhost",
+                black_blackd_port="1",
+            )
+        set_timeout.assert_called_once_with(ANY)
+        self.assertEqual(results[str(self.root / "other.py")].status, "error")
+        self.assertEqual(results[str(self.root / "ugly.py")].status, "error")
+
+    def test_black_worker_per_thread(self):
+        (self.root / "other.py").write_text("y=[ 4 ]\n")
+        (self.root / "ugly.py").write_text("x=[ 4 ]\n")
+        formatter, results = run_format_all(self.root, black_use_worker=True)
+        self.assertEqual(results[str(self.root / "other.py")].status, "reformatted")
+        self.assertEqual((self.root / "ugly.py").read_text(), "x = [4]\n")
+        self.assertNotIn(
+            sublack.BlackWorker.instances.get("black"), formatter.black_workers
+        )
+        # stopped with the run
+        self.assertTrue(all(w.proc is None for w in formatter.black_workers))
+
+    def test_inprocess_one_thread(self):
+        (self.root / "ugly.py").write_text("x=[ 5 ]\n")
+        with patch.object(
+            formatall, "ThreadPoolExecutor", wraps=formatall.ThreadPoolExecutor
+        ) as pool:
+            run_format_all(self.root, black_mode="inprocess")
+        pool.assert_called_once_with(max_workers=1)
+
+    def test_manifest_pyproject_changed(self):
+        (self.root / "pyproject.toml").write_text(
+            '[tool.black]\nextend-exclude = "good"\nline-length = 5\n'
+        )
+        formatter, results = run_format_all(self.root)
+        self.assertEqual(results[str(self.root / "ugly.py")].status, "reformatted")
+        self.assertEqual((self.root / "ugly.py").read_text(), "x = [\n    1\n]\n")
+
+
+@skipIf(not shutil.which("git"), "git not installed")
+class TestGitFormatAll(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        for name in ["modified.py", "staged.py", "clean.py"]:
+            (self.root / name).write_text("x=1\n")
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git(
+            "-c", "user.name=sublack", "-c", "user.email=s@b", "commit", "-qm", "init"
+        )
+        (self.root / "modified.py").write_text("x=2\n")
+        (self.root / "staged.py").write_text("x=3\n")
+        self.git("add", "staged.py")
+        (self.root / "untracked.py").write_text("x=4\n")
+        (self.root / "untracked.txt").write_text("x=5\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def git(self, *args):
+        subprocess.check_call(["git"] + list(args), cwd=str(self.root))
+
+    def test_changed_files(self):
+        window = MagicMock()
+        window.folders.return_value = [str(self.root)]
+        self.assertEqual(
+            formatall.GitFormatAll(window).get_changed_files(str(self.root)),
+            ["/modified.py", "/staged.py", "/untracked.py", "/untracked.txt"],
+        )
+
+    def test_run(self):
+        formatter, results = run_format_all(self.root, formatall.GitFormatAll)
+        self.assertEqual(
+            sorted(Path(k).name for k in results),
+            ["modified.py", "staged.py", "untracked.py"],
+        )
+        self.assertEqual((self.root / "clean.py").read_text(), "x=1\n")
+        self.assertEqual((self.root / "modified.py").read_text(), "x = 2\n")
+
+    def test_git_failed(self):
+        formatter, results = run_format_all(
+            self.root, partial(formatall.GitFormatAll, base="nobranch")
+        )
+        self.assertEqual(list(results), [str(self.root)])
+        self.assertEqual(results[str(self.root)].status, "error")
+        self.assertIn("nobranch", results[str(self.root)].message)
+        self.assertEqual((formatter.done, formatter.failed), (1, 1))
+        self.assertEqual((self.root / "modified.py").read_text(), "x=2\n")
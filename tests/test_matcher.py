@@ -0,0 +1,141 @@
+import tempfile
+from unittest import TestCase
+
+from fixtures import sublack
+
+matcher = sublack.matcher
+Path = sublack.utils.Path
+
+
+class TestWalk(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        for name in [
+            "a.py",
+            "pkg/b.py",
+            "pkg/c.pyi",
+            ".venv/d.py",
+            "gen/e.py",
+            "f.txt",
+        ]:
+            path = self.root / name
+            if not path.parent.exists():
+                path.parent.mkdir()
+            path.write_text("x = 1\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def files(self, options=None, gitignore=()):
+        walk = matcher.FileMatcher(self.root, options, gitignore).walk()
+        return [str(Path(p).relative_to(self.root)).replace("\\", "/") for p in walk]
+
+    def test_default(self):
+        self.assertEqual(self.files(), ["a.py", "gen/e.py", "pkg/b.py", "pkg/c.pyi"])
+
+    def test_include_exclude(self):
+        self.assertEqual(
+            self.files(
+                {"include": r"\.py$", "exclude": "/gen/", "extend-exclude": r"^/a\.py"}
+            ),
+            [".venv/d.py", "pkg/b.py"],
+        )
+
+    def test_verbose_pattern(self):
+        exclude = """
+        /(
+            gen
+          | pkg
+        )/
+        """
+        self.assertEqual(self.files({"exclude": exclude}), ["a.py", ".venv/d.py"])
+
+    def test_gitignore(self):
+        self.assertEqual(
+            self.files(gitignore=["# generated", "gen/", "*.pyi"]), ["a.py", "pkg/b.py"]
+        )
+
+    def test_gitignore_unused_with_exclude(self):
+        self.assertEqual(
+            self.files({"exclude": "/pkg/"}, gitignore=["gen/"]),
+            ["a.py", ".venv/d.py", "gen/e.py"],
+        )
+
+
+class TestFileMatcher(TestCase):
+    def test_match(self):
+        files = matcher.FileMatcher("/root")
+        self.assertTrue(files.match("/pkg/a.py"))
+        self.assertFalse(files.match("/pkg/a.txt"))
+        self.assertFalse(files.match("/build/a.py"))
+        self.assertFalse(files.match("/a/.venv/b/a.py"))
+
+    def test_force_exclude(self):
+        files = matcher.FileMatcher("/root", {"force-exclude": "migrations"})
+        self.assertFalse(files.match("/app/migrations/0001.py"))
+        self.assertTrue(files.match("/app/models.py"))
+
+    def test_match_file(self):
+        files = matcher.FileMatcher(
+            "/root", {"exclude": "/gen/", "force-exclude": "migrations"}, ["*.pyw"]
+        )
+        # given explicitly: include, default excludes and .gitignore don't apply
+        self.assertTrue(files.match_file("/build/a.py"))
+        self.assertTrue(files.match_file("/app.pyw"))
+        self.assertTrue(files.match_file("/script"))
+        self.assertFalse(files.match_file("/gen/a.py"))
+        self.assertFalse(files.match_file("/app/migrations/0001.py"))
+
+    def test_verdicts_cached(self):
+        files = matcher.FileMatcher("/root", {"exclude": "/gen/"})
+        self.assertFalse(files.match("/gen/a/b.py"))
+        self.assertEqual(
+            files.excluded_dirs,
+            {"/gen/": True, "/gen/a/": True},
+        )
+        files.excludes = []
+        self.assertFalse(files.match("/gen/a/b.py"))
+        self.assertFalse(files.match("/gen/a/c.py"))
+
+    def test_relative(self):
+        files = matcher.FileMatcher(Path("/root"))
+        self.assertEqual(files.relative(Path("/root/pkg/a.py")), "/pkg/a.py")
+        self.assertIsNone(files.relative(Path("/other/a.py")))
+
+
+class TestGitignore(TestCase):
+    def ignored(self, line, relative):
+        pattern, negated = matcher.translate_gitignore(line)
+        return bool(pattern.search(relative))
+
+    def test_blank_and_comments(self):
+        self.assertIsNone(matcher.translate_gitignore(""))
+        self.assertIsNone(matcher.translate_gitignore("# comment"))
+        self.assertIsNotNone(matcher.translate_gitignore("\\#file"))
+
+    def test_anywhere(self):
+        self.assertTrue(self.ignored("*.pyc", "/a/b.pyc"))
+        self.assertTrue(self.ignored("build", "/src/build/"))
+        self.assertFalse(self.ignored("build", "/src/builder/"))
+
+    def test_anchored(self):
+        self.assertTrue(self.ignored("/build", "/build/"))
+        self.assertFalse(self.ignored("/build", "/src/build/"))
+        self.assertTrue(self.ignored("doc/*.py", "/doc/a.py"))
+        self.assertFalse(self.ignored("doc/*.py", "/doc/sub/a.py"))
+
+    def test_directory_only(self):
+        self.assertTrue(self.ignored("gen/", "/gen/"))
+        self.assertFalse(self.ignored("gen/", "/gen"))
+
+    def test_double_star(self):
+        self.assertTrue(self.ignored("**/gen", "/a/b/gen/"))
+        self.assertTrue(self.ignored("a/**/b.py", "/a/b.py"))
+        self.assertTrue(self.ignored("a/**/b.py", "/a/x/y/b.py"))
+        self.assertTrue(self.ignored("a/**", "/a/x.py"))
+
+    def test_negation(self):
+        files = matcher.FileMatcher("/root", gitignore=["*.py", "!keep.py"])
+        self.assertFalse(files.match("/a.py"))
+        self.assertTrue(files.match("/keep.py"))
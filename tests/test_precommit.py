@@ -0,0 +1,106 @@
+import os
+import tempfile
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+from fixtures import sublack
+
+precommit = sublack.precommit
+sqlite3 = precommit.sqlite3
+
+CONFIG = {
+    "repos": [
+        {
+            "repo": "https://github.com/pre-commit/pygrep-hooks",
+            "rev": "v1.0.0",
+            "hooks": [{"id": "rst-backticks"}],
+        },
+        {
+            "repo": "https://github.com/psf/black",
+            "rev": "22.3.0",
+            "hooks": [{"id": "black", "args": ["--line-length=100"]}],
+        },
+    ]
+}
+
+
+@skipIf(sqlite3 is None, "no sqlite3")
+class TestResolve(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = patch.dict(os.environ, {"PRE_COMMIT_HOME": self.tmp.name})
+        self.env.start()
+        self.repo = os.path.join(self.tmp.name, "repoabc")
+        self.black = os.path.join(self.repo, "py_env-python3", "bin", "black")
+        os.makedirs(os.path.dirname(self.black))
+        open(self.black, "w").close()
+        db = sqlite3.connect(os.path.join(self.tmp.name, "db.db"))
+        db.execute("CREATE TABLE repos (repo TEXT, ref TEXT, path TEXT)")
+        db.execute(
+            "INSERT INTO repos VALUES (?, ?, ?)",
+            ("https://github.com/psf/black", "22.3.0", self.repo),
+        )
+        db.commit()
+        db.close()
+        precommit._RESOLVED.clear()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def resolve(self, config):
+        return precommit.resolve(precommit.PreCommitConfig(config))
+
+    def test_black_hook(self):
+        repo, hook = precommit.black_hook(CONFIG)
+        self.assertEqual(repo["rev"], "22.3.0")
+        self.assertEqual(hook["id"], "black")
+        self.assertIsNone(precommit.black_hook({"repos": []}))
+
+    def test_pre_commit_config(self):
+        config = precommit.PreCommitConfig(CONFIG)
+        self.assertTrue(config.uses_black)
+        self.assertEqual(
+            (config.repo, config.rev, config.args),
+            ("https://github.com/psf/black", "22.3.0", ["--line-length=100"]),
+        )
+        self.assertFalse(precommit.PreCommitConfig(None).uses_black)
+
+    def test_resolve(self):
+        black = self.resolve(CONFIG)
+        self.assertEqual(black.executable, self.black)
+        self.assertEqual(
+            black.get_command_line("a.pyi", ["--diff"]),
+            [self.black, "-", "--diff", "--line-length=100", "--pyi"],
+        )
+
+    def test_resolve_once(self):
+        self.resolve(CONFIG)
+        with patch.object(precommit, "repo_path") as repo_path:
+            self.assertEqual(self.resolve(CONFIG).executable, self.black)
+        repo_path.assert_not_called()
+
+    def test_not_installed(self):
+        config = {
+            "repos": [
+                {
+                    "repo": "https://github.com/psf/black",
+                    "rev": "23.1.0",
+                    "hooks": [{"id": "black"}],
+                }
+            ]
+        }
+        self.assertIsNone(self.resolve(config))
+
+    def test_local_system_hook(self):
+        config = {
+            "repos": [
+                {
+                    "repo": "local",
+                    "hooks": [
+                        {"id": "black", "language": "system", "entry": "black -q"}
+                    ],
+                }
+            ]
+        }
+        self.assertEqual(self.resolve(config).get_command_line(), ["black", "-", "-q"])
@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+from fixtures import sublack
+
+ranges = sublack.ranges
+
+SOURCE = """import os
+x = [
+    1,
+]
+
+
+@decorator
+@other
+def f():
+    pass
+
+
+# comment
+if x:
+    pass
+else:
+    pass
+y = 1
+"""
+
+
+class TestRanges(TestCase):
+    def test_supports_line_ranges(self):
+        self.assertTrue(ranges.supports_line_ranges("black, 23.11.0 (compiled: no)"))
+        self.assertTrue(ranges.supports_line_ranges("black, version 24.1.0"))
+        self.assertFalse(ranges.supports_line_ranges("black, version 19.3b0"))
+        self.assertFalse(ranges.supports_line_ranges(""))
+
+    def test_top_level_blocks(self):
+        self.assertEqual(
+            ranges.top_level_blocks(SOURCE),
+            [(0, 0), (1, 3), (6, 12), (13, 16), (17, 17)],
+        )
+
+    def test_top_level_blocks_no_final_newline(self):
+        self.assertEqual(ranges.top_level_blocks("a\nb"), [(0, 0), (1, 1)])
+
+    def test_top_level_blocks_error(self):
+        with self.assertRaises(Exception):
+            ranges.top_level_blocks("x = (\n")
+
+    def test_blocks_for_lines(self):
+        blocks = ranges.top_level_blocks(SOURCE)
+        self.assertEqual(ranges.blocks_for_lines(blocks, [8]), [(6, 12)])
+        self.assertEqual(ranges.blocks_for_lines(blocks, [4, 5]), [])
+        # adjacent blocks are merged
+        self.assertEqual(
+            ranges.blocks_for_lines(blocks, [0, 2, 16]), [(0, 3), (13, 16)]
+        )
+        self.assertEqual(ranges.blocks_for_lines(blocks, [14, 17]), [(13, 17)])
+
+    def test_line_ranges_args(self):
+        self.assertEqual(
+            ranges.line_ranges_args([(0, 3), (13, 17)]),
+            ["--line-ranges", "1-4", "--line-ranges", "14-18"],
+        )
+
+    def test_without_line_ranges(self):
+        self.assertEqual(
+            ranges.without_line_ranges(
+                ["black", "-", "--line-ranges", "1-4", "--fast"]
+            ),
+            ["black", "-", "--fast"],
+        )
+
+    def test_splice(self):
+        text = "a=1\nb=2\nc=3"
+        self.assertEqual(
+            ranges.splice(text, [(0, 0), (2, 2)], ["a = 1\n", "c = 3\n"]),
+            "a = 1\nb=2\nc = 3",
+        )
@@ -57,6 +57,11 @@ class TestUtils(TestCase):
             "black_blackd_autostart": 4,
             "black_use_precommit": 4,
             "black_confirm_formatall": 4,
+            "black_use_worker": 4,
+            "black_mode": 4,
+            "black_sys_path": 4,
+            "black_async": 4,
+            "black_on_save_modified_only": 4,
         }
 
         res = {
@@ -75,6 +80,11 @@ class TestUtils(TestCase):
             "black_blackd_autostart": 4,
             "black_use_precommit": 4,
             "black_confirm_formatall": 4,
+            "black_use_worker": 4,
+            "black_mode": 4,
+            "black_sys_path": 4,
+            "black_async": 4,
+            "black_on_save_modified_only": 4,
         }
 
         class View(str):
@@ -212,6 +222,32 @@ class TestUtils(TestCase):
             )
             self.assertEqual(sublack.utils.find_root_file(view, "some.file"), subpp)
 
+    def test_find_root_file_memoized(self):
+        with tempfile.TemporaryDirectory() as T:
+            root = Path(T)
+            view = View(Window({"file_path": str(Path(T, "working.py"))}, [T]))
+            self.assertIsNone(sublack.utils.find_root_file(view, "some.file"))
+
+            # missing file answer is kept
+            pp = root / "some.file"
+            pp.touch()
+            self.assertIsNone(sublack.utils.find_root_file(view, "some.file"))
+
+            # until a root file is saved
+            sublack.utils.RootIndex.invalidate()
+            self.assertEqual(sublack.utils.find_root_file(view, "some.file"), pp)
+
+            # found file deleted: searched again
+            pp.unlink()
+            self.assertIsNone(sublack.utils.find_root_file(view, "some.file"))
+
+    def test_root_index_ttl(self):
+        search = MagicMock(return_value=None)
+        with patch.object(sublack.utils, "ROOT_INDEX_TTL", 0):
+            sublack.utils.RootIndex.get(("test_ttl",), search)
+            sublack.utils.RootIndex.get(("test_ttl",), search)
+        self.assertEqual(search.call_count, 2)
+
     def test_read_pyproject(self):
         normal = '[other]\nbla = "bla"\n\n[tool.black]\nfast = true\nline-length = 1'
         error = '[other]bla = "bla"\n\n[tool.black]\nfast = true\nline-length = 1'
@@ -233,6 +269,56 @@ class TestUtils(TestCase):
             config = sublack.utils.read_pyproject_toml(pp)
             self.assertEqual(config, {})
 
+    def test_read_pyproject_cached(self):
+        with tempfile.TemporaryDirectory() as T:
+            pp = Path(T, "pyproject.toml")
+            with open(str(pp), "w") as f:
+                f.write("[tool.black]\nfast = true\n")
+            self.assertEqual(sublack.utils.read_pyproject_toml(pp), {"fast": True})
+            with patch.object(sublack.utils.toml, "load") as load:
+                self.assertEqual(sublack.utils.read_pyproject_toml(pp), {"fast": True})
+                load.assert_not_called()
+            # modified: parsed again
+            with open(str(pp), "w") as f:
+                f.write("[tool.black]\nline-length = 12\n")
+            self.assertEqual(sublack.utils.read_pyproject_toml(pp), {"line-length": 12})
+
+    def test_get_matcher(self):
+        with tempfile.TemporaryDirectory() as T:
+            with open(str(Path(T, "pyproject.toml")), "w") as f:
+                f.write('[tool.black]\nextend-exclude = "^/gen/"\n')
+            matcher = sublack.utils.get_matcher(T)
+            self.assertFalse(matcher.match("/gen/a.py"))
+            self.assertIs(sublack.utils.get_matcher(T), matcher)
+            # .gitignore added: built again
+            with open(str(Path(T, ".gitignore")), "w") as f:
+                f.write("old/\n")
+            self.assertIsNot(sublack.utils.get_matcher(T), matcher)
+            matcher = sublack.utils.get_matcher(T)
+            self.assertFalse(matcher.match("/old/a.py"))
+            self.assertTrue(matcher.match("/a.py"))
+
+    def test_match_exclude(self):
+        with tempfile.TemporaryDirectory() as T:
+            pyproject = Path(T, "pyproject.toml")
+            with open(str(pyproject), "w") as f:
+                f.write('[tool.black]\nforce-exclude = "migrations"\n')
+            view = MagicMock()
+            with patch.object(sublack.utils, "find_pyproject", return_value=pyproject):
+                view.file_name.return_value = str(Path(T, "migrations", "a.py"))
+                self.assertTrue(sublack.utils.match_exclude(view))
+                view.file_name.return_value = str(Path(T, "a.py"))
+                self.assertFalse(sublack.utils.match_exclude(view))
+                # only format all discovers files with black's defaults
+                view.file_name.return_value = str(Path(T, "build", "gen.py"))
+                self.assertFalse(sublack.utils.match_exclude(view))
+
+    def test_parse_black_version(self):
+        pbv = sublack.utils.parse_black_version
+        self.assertEqual(pbv("black, version 19.3b0"), "19.3b0")
+        self.assertEqual(pbv("black, 23.1.0 (compiled: yes)"), "23.1.0")
+        self.assertIsNone(pbv(""))
+
     def test_clear_cache(self):
         cache = sublack.utils.cache_path() / "formatted"
         with cache.open("w") as f:
@@ -241,6 +327,21 @@ class TestUtils(TestCase):
         sublack.utils.clear_cache()
         self.assertFalse(cache.open().read())
 
+    def test_read_pre_commit_config_cached(self):
+        with tempfile.TemporaryDirectory() as T:
+            path = Path(T, ".pre-commit-config.yaml")
+            path.write_text(pre_commit_config["repo_repo"])
+            config = sublack.utils.read_pre_commit_config(path)
+            self.assertEqual(
+                (config.rev, config.args), ("18.6b4", ["--safe", "--quiet"])
+            )
+            with patch.object(sublack.utils.yaml, "load") as load:
+                self.assertIs(sublack.utils.read_pre_commit_config(path), config)
+                load.assert_not_called()
+            # modified: parsed again
+            path.write_text(pre_commit_config["nothing"])
+            self.assertFalse(sublack.utils.read_pre_commit_config(path).uses_black)
+
     def test_use_precommit(self):
         print("test use precommit")
         with tempfile.TemporaryDirectory() as T:
@@ -0,0 +1,195 @@
+import io
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from fixtures import sublack, blacked, unblacked
+
+worker = sublack.worker
+
+
+class TestProtocol(TestCase):
+    def test_frames(self):
+        stream = io.BytesIO()
+        worker.write_message(stream, {"action": "format", "args": ["-"]}, b"a=1")
+        stream.seek(0)
+        self.assertEqual(
+            worker.read_message(stream), ({"action": "format", "args": ["-"]}, b"a=1")
+        )
+
+    def test_closed_stream(self):
+        with self.assertRaises(EOFError):
+            worker.read_message(io.BytesIO(b"\x00\x00"))
+
+    def test_parse_args(self):
+        options = worker.parse_args(
+            "- -l 25 --fast --skip-string-normalization --target-version py37".split()
+        )
+        self.assertEqual(
+            options,
+            {
+                "line_length": 25,
+                "fast": True,
+                "string_normalization": False,
+                "magic_trailing_comma": True,
+                "preview": False,
+                "is_pyi": False,
+                "py36": False,
+                "target_versions": ["py37"],
+                "lines": [],
+            },
+        )
+        with self.assertRaises(worker.UnsupportedOption):
+            worker.parse_args(["-", "--diff"])
+        with self.assertRaises(worker.UnsupportedOption):
+            worker.parse_args(["-", "--config=pyproject.toml"])
+        with self.assertRaises(worker.UnsupportedOption):
+            worker.parse_args(["-", "-l"])
+
+    def test_parse_args_spellings(self):
+        options = worker.parse_args(
+            "- --line-length=100 -q -C --preview -t py38 --target-version=py39".split()
+        )
+        self.assertEqual(options["line_length"], 100)
+        self.assertFalse(options["magic_trailing_comma"])
+        self.assertTrue(options["preview"])
+        self.assertEqual(options["target_versions"], ["py38", "py39"])
+        self.assertEqual(worker.parse_args(["-", "-l79"])["line_length"], 79)
+
+    def test_parse_args_config(self):
+        config = {
+            "line-length": 100,
+            "target-version": ["py37"],
+            "skip_magic_trailing_comma": True,
+            "preview": False,
+            "extend-exclude": "gen",
+        }
+        self.assertEqual(
+            worker.config_args(config),
+            [
+                "--line-length",
+                "100",
+                "--skip-magic-trailing-comma",
+                "--target-version",
+                "py37",
+            ],
+        )
+        defaults = worker.parse_args(worker.config_args(config))
+        # command line wins
+        options = worker.parse_args(["-", "-l", "80", "-t", "py38"], defaults)
+        self.assertEqual(options["line_length"], 80)
+        self.assertEqual(options["target_versions"], ["py38"])
+        self.assertFalse(options["magic_trailing_comma"])
+        with self.assertRaises(worker.UnsupportedOption):
+            worker.parse_args(worker.config_args({"required-version": "22"}))
+
+    def test_parse_args_line_ranges(self):
+        options = worker.parse_args("- --line-ranges 1-3 --line-ranges 8-9".split())
+        self.assertEqual(options["lines"], [(1, 3), (8, 9)])
+
+    def test_decode_bytes(self):
+        self.assertEqual(worker.decode_bytes(b"a\r\n"), ("a\n", "utf-8", "\r\n"))
+        self.assertEqual(
+            worker.decode_bytes("# coding: latin-1\né".encode("latin-1")),
+            ("# coding: latin-1\né", "iso-8859-1", "\n"),
+        )
+
+
+class TestBlackWorker(TestCase):
+    def setUp(self):
+        self.worker = sublack.BlackWorker("black")
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_format(self):
+        returncode, out, err = self.worker(["-"], unblacked.encode())
+        self.assertEqual(returncode, 0)
+        self.assertEqual(out.decode(), blacked)
+        self.assertIn(b"reformatted", err)
+
+        returncode, out, err = self.worker(["-"], blacked.encode())
+        self.assertEqual(returncode, 0)
+        self.assertIn(b"unchanged", err)
+
+    def test_format_error(self):
+        returncode, out, err = self.worker(["-"], b"a b = 2")
+        self.assertEqual(returncode, 123)
+        self.assertIn(b"cannot format", err)
+
+    def test_format_config(self):
+        content = b"f(a,)\n"
+        self.assertEqual(self.worker(["-"], content)[1], b"f(\n    a,\n)\n")
+        self.assertEqual(
+            self.worker(["-"], content, {"skip-magic-trailing-comma": True})[1],
+            b"f(a)\n",
+        )
+
+    def test_unsupported_option(self):
+        with self.assertRaises(sublack.server.BlackWorkerError):
+            self.worker(["-", "--diff"], b"a=1")
+        # still running
+        self.assertEqual(self.worker(["-", "--line-length=100"], b"a=1")[1], b"a = 1\n")
+
+    def test_restart_after_crash(self):
+        self.worker(["-"], b"a=1")
+        pid = self.worker.proc.pid
+        sublack.kill_with_pid(pid)
+        self.worker.proc.wait()
+        self.assertEqual(self.worker(["-"], b"a=1")[1], b"a = 1\n")
+        self.assertNotEqual(pid, self.worker.proc.pid)
+
+    def test_recycle(self):
+        self.worker.max_requests = 2
+        self.worker(["-"], b"a=1")
+        pid = self.worker.proc.pid
+        self.worker(["-"], b"a=1")
+        self.assertEqual(pid, self.worker.proc.pid)
+        self.worker(["-"], b"a=1")
+        self.assertNotEqual(pid, self.worker.proc.pid)
+
+    def test_not_able_to_start(self):
+        with patch.object(sublack.server, "get_black_interpreter", return_value=False):
+            with self.assertRaises(sublack.server.BlackWorkerError):
+                self.worker(["-"], b"a=1")
+
+    def test_failure_kept(self):
+        crash = ["python", "-c", "import sys; sys.exit('No module named black')"]
+        with patch.object(self.worker, "get_command", return_value=crash) as cmd:
+            with self.assertRaisesRegex(
+                sublack.server.BlackWorkerError, "No module named black"
+            ):
+                self.worker(["-"], b"a=1")
+            # not started again
+            with self.assertRaisesRegex(
+                sublack.server.BlackWorkerError, "No module named black"
+            ):
+                self.worker(["-"], b"a=1")
+            self.assertEqual(cmd.call_count, 1)
+        # black changed
+        with patch.object(self.worker, "state", return_value="other"):
+            self.assertEqual(
+                self.worker(["-"], unblacked.encode())[1], blacked.encode()
+            )
+        self.assertIsNone(self.worker.failure)
+
+
+class TestIndexWorker(TestCase):
+    def setUp(self):
+        self.worker = sublack.IndexWorker("python")
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_index(self):
+        self.assertEqual(self.worker(b"def f():\n    pass\n", "utf-8"), [1, 2])
+        self.assertEqual(
+            self.worker("# coding: latin-1\na = 'é'\n".encode("latin-1"), "latin-1"),
+            [2],
+        )
+
+    def test_syntax_error(self):
+        with self.assertRaises(sublack.server.BlackWorkerError):
+            self.worker(b"a=", "utf-8")
+        # still running
+        self.assertEqual(self.worker(b"a=1", "utf-8"), [1])